@@ -0,0 +1,83 @@
+import time
+import sqlite3
+import hashlib
+import threading
+import contextlib
+from __init__ import *
+from typing import Dict, Iterator, Optional
+
+
+def file_hash(path: str, block_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class CacheIndex(object):
+    """
+    Индекс файлового кэша в SQLite: ключ (хеш содержимого) -> путь, размер и время последнего обращения.
+    Поиск идёт по первичному ключу, а при превышении max_size удаляются давно не использованные файлы.
+    """
+
+    def __init__(self, db_path: str, max_size: int):
+        self.db_path: str = db_path
+        self.max_size: int = max_size
+        self._lock: threading.Lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT path FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.isfile(row[0]):
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, path: str) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, path, size, last_access) VALUES (?, ?, ?, ?)",
+                         (key, path, os.path.getsize(path), time.time()))
+            self._evict(conn, keep_key=key)
+
+    def _evict(self, conn: sqlite3.Connection, keep_key: str) -> None:
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        rows = conn.execute("SELECT key, path, size FROM cache WHERE key != ? ORDER BY last_access",
+                            (keep_key,)).fetchall()
+        for key, path, size in rows:
+            if total_size <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total_size -= size
+            logger.info(f"Removed {path} from cache, cache size is {total_size} bytes")
+
+
+_indexes: Dict[str, CacheIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_cache_index(db_path: str, max_size: int) -> CacheIndex:
+    with _indexes_lock:
+        if db_path not in _indexes:
+            _indexes[db_path] = CacheIndex(db_path, max_size)
+        return _indexes[db_path]
@@ -0,0 +1,169 @@
+import re
+import time
+import fcntl
+import hashlib
+import struct
+import contextlib
+from __init__ import *
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+UPLOAD_PARTS_DIR = os.environ.get("UPLOAD_PARTS_DIR", f"{os.environ.get('PATH_DOCUMENTS')}/uploads")
+UPLOAD_BUFFER_SIZE = int(os.environ.get("UPLOAD_BUFFER_SIZE", 64 * 1024))
+# Состояние завершённой загрузки хранится, чтобы потерянную задачу можно было запустить заново
+UPLOAD_TTL = float(os.environ.get("UPLOAD_TTL", 24 * 3600))
+# Заголовок файла состояния: id задачи обработки, размер файла, число кусков и размер куска.
+# За ним битовая карта полученных кусков и sha256 каждого куска
+STATE_HEADER = struct.Struct("32sQII")
+CHUNK_DIGEST_SIZE = hashlib.sha256().digest_size
+UPLOAD_ID = re.compile(r"[0-9A-Za-z-]{1,64}")
+
+
+def remove_expired_uploads(directory: str = UPLOAD_PARTS_DIR, ttl: float = UPLOAD_TTL) -> None:
+    """Удаляет куски и состояния загрузок, которые не менялись дольше ttl: брошенные и давно завершённые"""
+    now = time.time()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith((".part", ".chunks")):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                if now - entry.stat().st_mtime > ttl:
+                    os.remove(entry.path)
+                    logger.info(f"Removed expired upload file {entry.path}")
+
+
+class ChunkedUpload(object):
+    """
+    Файл, собираемый из кусков Dropzone в любом порядке и параллельно. Каждый кусок пишется по своему смещению,
+    полученные куски отмечаются в битовой карте файла состояния под flock, так что загрузку можно продолжить
+    после обрыва с тем же upload_id
+    """
+
+    def __init__(self, upload_id: str, directory: str = UPLOAD_PARTS_DIR):
+        if not UPLOAD_ID.fullmatch(upload_id):
+            raise ValueError(f"Wrong upload id {upload_id}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self.upload_id: str = upload_id
+        self.part_path: str = os.path.join(directory, f"{upload_id}.part")
+        self.state_path: str = os.path.join(directory, f"{upload_id}.chunks")
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(upload_id={self.upload_id})'
+
+    @contextlib.contextmanager
+    def _lock_state(self, total_size: int = None, total_chunks: int = None, chunk_size: int = None) -> Iterator[int]:
+        """
+        Файл состояния под эксклюзивной блокировкой, создаётся первым куском, который знает размеры.
+        Размеры следующих кусков должны совпадать с записанными в заголовке, иначе куски перемешаются
+        """
+        flags = os.O_RDWR | (os.O_CREAT if total_chunks is not None else 0)
+        fd = os.open(self.state_path, flags, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size == 0:
+                if total_chunks is None:
+                    raise FileNotFoundError(f"{self} has no chunks yet")
+                header = STATE_HEADER.pack(b"", total_size, total_chunks, chunk_size)
+                os.pwrite(fd, header + bytes((total_chunks + 7) // 8 + total_chunks * CHUNK_DIGEST_SIZE), 0)
+            elif total_chunks is not None:
+                _, *sizes = STATE_HEADER.unpack(os.pread(fd, STATE_HEADER.size, 0))
+                if sizes != [total_size, total_chunks, chunk_size]:
+                    raise ValueError(f"{self} was started with file size, chunks count and chunk size {sizes}, "
+                                     f"got {[total_size, total_chunks, chunk_size]}")
+            yield fd
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read_state(fd: int) -> tuple:
+        job_id, total_size, total_chunks, _ = STATE_HEADER.unpack(os.pread(fd, STATE_HEADER.size, 0))
+        bitmap = os.pread(fd, (total_chunks + 7) // 8, STATE_HEADER.size)
+        return job_id.rstrip(b"\0").decode(), total_size, total_chunks, bitmap
+
+    @staticmethod
+    def _get_content_id(fd: int) -> str:
+        """
+        Хеш содержимого из хешей кусков, посчитанных при записи, так что файл не читается ещё раз.
+        Одинаковые файлы, загруженные кусками одного размера, получают один и тот же хеш
+        """
+        header = os.pread(fd, STATE_HEADER.size, 0)
+        _, total_size, total_chunks, chunk_size = STATE_HEADER.unpack(header)
+        digests = os.pread(fd, total_chunks * CHUNK_DIGEST_SIZE, STATE_HEADER.size + (total_chunks + 7) // 8)
+        return hashlib.sha256(STATE_HEADER.pack(b"", total_size, total_chunks, chunk_size) + digests).hexdigest()
+
+    @staticmethod
+    def _get_received(bitmap: bytes, total_chunks: int) -> List[int]:
+        return [i for i in range(total_chunks) if bitmap[i // 8] >> (i % 8) & 1]
+
+    def _write_data(self, offset: int, stream: BinaryIO) -> bytes:
+        """Пишет кусок по смещению и возвращает его sha256, посчитанный по тем же блокам"""
+        sha256 = hashlib.sha256()
+        fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            for block in iter(lambda: stream.read(UPLOAD_BUFFER_SIZE), b""):
+                os.pwrite(fd, block, offset)
+                sha256.update(block)
+                offset += len(block)
+        finally:
+            os.close(fd)
+        return sha256.digest()
+
+    def write_chunk(self, index: int, offset: int, stream: BinaryIO, total_size: int, total_chunks: int,
+                    chunk_size: int) -> dict:
+        """Пишет кусок, если его ещё нет, и отмечает его в битовой карте вместе с хешем только после записи"""
+        if not 0 <= index < total_chunks:
+            raise ValueError(f"Chunk {index} is out of {total_chunks} chunks")
+        if offset != index * chunk_size:
+            raise ValueError(f"Chunk {index} has offset {offset}, expected {index * chunk_size}")
+        if not os.path.exists(self.state_path):
+            remove_expired_uploads(self.directory)
+        with self._lock_state(total_size, total_chunks, chunk_size) as fd:
+            _, _, _, bitmap = self._read_state(fd)
+        if not bitmap[index // 8] >> (index % 8) & 1:
+            digest = self._write_data(offset, stream)
+            with self._lock_state() as fd:
+                bitmap_size = (total_chunks + 7) // 8
+                os.pwrite(fd, digest, STATE_HEADER.size + bitmap_size + index * CHUNK_DIGEST_SIZE)
+                byte_position = STATE_HEADER.size + index // 8
+                os.pwrite(fd, bytes([os.pread(fd, 1, byte_position)[0] | 1 << (index % 8)]), byte_position)
+        return self.get_status()
+
+    def get_status(self) -> dict:
+        """Полученные куски, чтобы клиент мог продолжить загрузку"""
+        try:
+            with self._lock_state() as fd:
+                job_id, _, total_chunks, bitmap = self._read_state(fd)
+        except FileNotFoundError:
+            return {"upload_id": self.upload_id, "received": [], "total_chunks": None, "job_id": None}
+        return {"upload_id": self.upload_id, "received": self._get_received(bitmap, total_chunks),
+                "total_chunks": total_chunks, "job_id": job_id or None}
+
+    def complete(self, get_target_path: Callable[[str], str], submit_job: Callable[[str, str], str],
+                 is_job_known: Callable[[str], bool]) -> Optional[str]:
+        """
+        Когда пришли все куски, кладёт файл по пути get_target_path(хеш содержимого) и один раз запускает обработку
+        submit_job(путь, хеш). Файл с тем же содержимым хранится один раз: если он уже лежит по этому пути,
+        собранный файл удаляется. Повторный вызов возвращает ту же задачу, пока она известна is_job_known.
+        None, если кусков не хватает
+        """
+        if not os.path.exists(self.state_path):
+            return None
+        with self._lock_state() as fd:
+            job_id, total_size, total_chunks, bitmap = self._read_state(fd)
+            if job_id and is_job_known(job_id):
+                return job_id
+            if len(self._get_received(bitmap, total_chunks)) != total_chunks:
+                return None
+            content_id = self._get_content_id(fd)
+            target_path = get_target_path(content_id)
+            if os.path.exists(self.part_path):
+                if os.path.getsize(self.part_path) != total_size:
+                    raise ValueError("Size mismatch")
+                if os.path.exists(target_path):
+                    os.remove(self.part_path)
+                else:
+                    os.replace(self.part_path, target_path)
+            job_id = submit_job(target_path, content_id)
+            os.pwrite(fd, job_id.encode().ljust(32, b"\0")[:32], 0)
+            logger.info(f"{self} is completed to {target_path}, job is {job_id}")
+            return job_id
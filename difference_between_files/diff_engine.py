@@ -0,0 +1,74 @@
+import re
+from dataclasses import dataclass
+from typing import Iterator, List, Tuple
+from rapidfuzz.distance import Levenshtein
+
+from difference_between_files.acceptable import replacements, skips
+
+# Символы, которые нельзя записать в XML документа docx
+ILLEGAL_XML_CHARS = re.compile(u"[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+")
+
+
+@dataclass
+class DiffRun:
+    """Кусок строки протокола: текст левой и правой колонки и нужно ли их подсветить"""
+    left: str
+    right: str
+    left_highlight: bool = False
+    right_highlight: bool = False
+
+
+def sanitize(text: str) -> str:
+    return ILLEGAL_XML_CHARS.sub('', text)
+
+
+def is_different(text1: str, text2: str) -> bool:
+    return text1 != text2
+
+
+def get_opcodes(text1: str, text2: str) -> Iterator[Tuple[str, int, int, int, int]]:
+    """
+    Посимвольные правки без учёта регистра. Соседние правки склеиваются в одну, как в difflib,
+    чтобы замены из нескольких символов (щ -> пз) находились в acceptable.replacements
+    """
+    a, b = text1.lower(), text2.lower()
+    if a == b:
+        if a:
+            yield "equal", 0, len(a), 0, len(b)
+        return
+    pending = None
+    for tag, i1, i2, j1, j2 in Levenshtein.opcodes(a, b):
+        if tag == "equal":
+            if pending is not None:
+                yield pending
+                pending = None
+            yield tag, i1, i2, j1, j2
+        elif pending is None:
+            pending = tag, i1, i2, j1, j2
+        else:
+            pending = "replace", pending[1], i2, pending[3], j2
+    if pending is not None:
+        yield pending
+
+
+def get_diff_runs(text1: str, text2: str) -> Tuple[List[DiffRun], int, int]:
+    """Куски строки протокола и число различающихся символов слева и справа, правила acceptable за один проход"""
+    runs = []
+    left_diff_count = 0
+    right_diff_count = 0
+    for op, i1, i2, j1, j2 in get_opcodes(text1, text2):
+        left, right = text1[i1:i2], text2[j1:j2]
+        run = DiffRun(sanitize(left), sanitize(right))
+        if op in ("delete", "insert"):
+            if left not in skips:
+                run.left_highlight = True
+                left_diff_count += i2 - i1
+            if right not in skips:
+                run.right_highlight = True
+                right_diff_count += j2 - j1
+        elif op == "replace" and (left, right) not in replacements and (right, left) not in replacements:
+            run.left_highlight = run.right_highlight = True
+            left_diff_count += i2 - i1
+            right_diff_count += j2 - j1
+        runs.append(run)
+    return runs, left_diff_count, right_diff_count
@@ -1,17 +1,27 @@
-import difflib
 import io
+import os
 import re
 import logging
-from docx import Document
-from docx.enum.text import WD_COLOR_INDEX
-from docx.shared import Inches
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Iterator, NamedTuple, Optional
 from string import punctuation
 
-from difference_between_files.acceptable import replacements, skips
+from difference_between_files.diff_engine import DiffRun, get_diff_runs, is_different, sanitize
+from difference_between_files.report_writer import ReportRow, iter_report
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('Documents')
 
+PARAGRAPH_NUMBER = re.compile(r"^(\.?,?\d{0,2}){0,4} ?")
+PARAGRAPH_NUMBER_AND_END = re.compile(r"(?:^(\.?,?\d{0,2}){0,4} ?|\.?,?$)")
+
+# 0 или 1 считают различия строк протокола в текущем процессе
+DIFF_WORKERS = int(os.environ.get("DIFF_WORKERS", 0))
+DIFF_CHUNK_SIZE = int(os.environ.get("DIFF_CHUNK_SIZE", 16))
+
 
 class DiffData:
     def __init__(self, current_number, last_known_number, first_column, second_column, is_different):
@@ -30,17 +40,11 @@ def list_from_string(document: str) -> list:
 def get_diff(list1: list, list2: list) -> list:
     last_known_number = ''
     for text1, text2 in zip(list1, list2):
-        diff_items = difflib.ndiff([text1], [text2])
-        logger.info('Find error')
-        for diff in diff_items:
-            diff = diff.strip('®')
-            is_different = diff[0] in ('+', '-')
-            break
-        match_number = re.search(r"^(\.?,?\d{0,2}){0,4} ?", text1)
+        match_number = PARAGRAPH_NUMBER.search(text1)
         current_number = match_number[0] if match_number and not match_number[0].isspace() else ""
         last_known_number = current_number if current_number else last_known_number
         diffs_data = DiffData(current_number=current_number, last_known_number=last_known_number, first_column=text1,
-                              second_column=text2, is_different=is_different)
+                              second_column=text2, is_different=is_different(text1, text2))
 
         yield diffs_data
 
@@ -63,64 +67,22 @@ def filter_diffs(diffs):
         diffs[i[0]] = i[2]
     return diffs
 
-def sequence_matcher(table,text1,text2,count_error,number):
-    cells = table.add_row().cells
-    cells[0].width = Inches(0.6)
-    cells[1].width = Inches(3)
-    cells[2].width = Inches(3)
-    cells[0].text = number
-
-    left_diff_count = 0
-    right_diff_count = 0
-    sequence = difflib.SequenceMatcher(a=text1.lower(), b=text2.lower(), autojunk=False)
-
-    paragraph1 = cells[1].paragraphs[0]
-    paragraph2 = cells[2].paragraphs[0]
-
-    logger.info('Write document')
-    for op, i1, i2, j1, j2 in sequence.get_opcodes():
-        run1 = re.sub(u"[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+", '', text1[i1:i2])
-        run2 = re.sub(u"[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+", '', text2[i1:i2])
-        run1 = paragraph1.add_run(run1)
-        run2 = paragraph2.add_run(run2)
-        if op in ("delete", "insert"):
-            if text1[i1:i2] not in skips:
-                run1.font.highlight_color = WD_COLOR_INDEX.YELLOW
-                left_diff_count += i2 - i1
-            if text2[j1:j2] not in skips:
-                run2.font.highlight_color = WD_COLOR_INDEX.YELLOW
-                right_diff_count += j2 - j1
-        if op == "replace":
-            if (text1[i1:i2], text2[j1:j2]) not in replacements and (
-                    text2[j1:j2],
-                    text1[i1:i2],
-            ) not in replacements:
-                run1.font.highlight_color = WD_COLOR_INDEX.YELLOW
-                run2.font.highlight_color = WD_COLOR_INDEX.YELLOW
-                left_diff_count += i2 - i1
-                right_diff_count += j2 - j1
+class RowTask(NamedTuple):
+    """Строка протокола до подсчёта различий"""
+    number: str
+    text1: str
+    text2: str
+    is_diff: bool
+
 
+def compute_row(task: RowTask, count_error: int) -> Optional[ReportRow]:
+    """Куски строки протокола, None если различий не больше count_error. Не зависит от других строк"""
+    if not task.is_diff:
+        return ReportRow(task.number, [DiffRun(sanitize(task.text1), sanitize(task.text2))])
+    diff_runs, left_diff_count, right_diff_count = get_diff_runs(task.text1, task.text2)
     if left_diff_count <= count_error and right_diff_count <= count_error and count_error>0:
-        table._tbl.remove(table.rows[-1]._tr)
-
-
-def add_paragraph(table,text1,text2,number):
-    try:
-        cells = table.add_row().cells
-        cells[0].width = Inches(0.6)
-        cells[1].width = Inches(3)
-        cells[2].width = Inches(3)
-        cells[0].text = number
-        paragraph1 = cells[1].paragraphs[0]
-        paragraph2 = cells[2].paragraphs[0]
-        text1 = re.sub(u"[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+", '', text1)
-        text2 = re.sub(u"[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+", '', text2)
-        paragraph1.add_run(text1)
-        paragraph2.add_run(text2)
-        return
-    except Exception as ex:
-        print(ex)
-        print()
+        return None
+    return ReportRow(task.number, diff_runs)
 
 def flagg_append(flag_text,text1,text2,number,diff):
     flag_text[1].append(text1)
@@ -130,22 +92,8 @@ def flagg_append(flag_text,text1,text2,number,diff):
 
 
 
-def save_disagreement(file1: str, file2: str, count_error: int, flag: bool, file_name_docx: str, file_name_pdf: str) \
-        -> io.BytesIO:
-    logger.info('Create document')
-    result = Document()
-    result.add_heading("Протокол разногласий")
-    table = result.add_table(rows=1, cols=3)
-    table.style = "TableGrid"
-    table.autofit = False
-    heading_cells = table.rows[0].cells
-    heading_cells[0].text = "№"
-    heading_cells[0].width = Inches(0.6)
-    heading_cells[1].text = f"Редакция заказчика\n{file_name_docx}"
-    heading_cells[1].width = Inches(3)
-    heading_cells[2].text = f"Редакция исполнителя\n{file_name_pdf}"
-    heading_cells[2].width = Inches(3)
-
+def get_disagreement_row_tasks(file1: str, file2: str, count_error: int, flag: bool) -> Iterator[RowTask]:
+    """Строки протокола в порядке пунктов, в режиме flag пункты собираются вместе со своими подпунктами"""
     list1, list2 = list_from_string(file1), list_from_string(file2)
     diffs = list(get_diff(list1, list2))
     number_flag = ''
@@ -155,13 +103,13 @@ def save_disagreement(file1: str, file2: str, count_error: int, flag: bool, file
             number = ''
         else:
             number = diff.last_known_number + ' ✓ ' if not diff.current_number else diff.current_number
-        text1, text2 = [re.sub(r"(?:^(\.?,?\d{0,2}){0,4} ?|\.?,?$)", "", text).strip() for text in
+        text1, text2 = [PARAGRAPH_NUMBER_AND_END.sub("", text).strip() for text in
                         [diff.first_column, diff.second_column]]
         if not diff.is_different and count_error == 0 and not flag:
-            add_paragraph(table,text1,text2,number)
+            yield RowTask(number, text1, text2, is_diff=False)
             continue
         if diff.is_different and count_error == 0 and not flag:
-            sequence_matcher(table,text1,text2,count_error,number)
+            yield RowTask(number, text1, text2, is_diff=True)
             continue
 
         if count_error == 0 and flag:
@@ -172,22 +120,21 @@ def save_disagreement(file1: str, file2: str, count_error: int, flag: bool, file
             else:
                 if len(flag_text[1])>1 :
                     if  any([i for i in flag_text[3]]):
-                        sequence_matcher(table, '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), count_error, flag_text[0])
+                        yield RowTask(flag_text[0], '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), is_diff=True)
                         flag_text = [0, [], [],[]]
                         flagg_append(flag_text, text1, text2, number, diff)
                     else:
-                        add_paragraph(table,'\n'.join(flag_text[1]),'\n'.join(flag_text[2]),flag_text[0])
+                        yield RowTask(flag_text[0], '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), is_diff=False)
                         flag_text = [0, [], [], []]
                         flagg_append(flag_text, text1, text2, number, diff)
                 else:
                     if len(flag_text[1])==1 and not flag_text[3][0]:
-                        add_paragraph(table, '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), flag_text[0])
+                        yield RowTask(flag_text[0], '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), is_diff=False)
                         flag_text = [0, [], [],[]]
                         flagg_append(flag_text, text1, text2, number, diff)
                     else:
                         if len(flag_text[1]) == 1 and flag_text[3][0]:
-                            sequence_matcher(table, '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), count_error,
-                                             flag_text[0])
+                            yield RowTask(flag_text[0], '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), is_diff=True)
                             flag_text = [0, [], [], []]
                             flagg_append(flag_text, text1, text2, number, diff)
 
@@ -196,7 +143,7 @@ def save_disagreement(file1: str, file2: str, count_error: int, flag: bool, file
 
                 continue
         if count_error>0 and not flag:
-            sequence_matcher(table,text1,text2,count_error,number)
+            yield RowTask(number, text1, text2, is_diff=True)
             continue
 
         if count_error>0 and flag:
@@ -208,12 +155,12 @@ def save_disagreement(file1: str, file2: str, count_error: int, flag: bool, file
                         flag_text = [0, [], [], []]
                         continue
                     else:
-                        sequence_matcher(table,'\n'.join(flag_text[1]),'\n'.join(flag_text[2]),count_error,flag_text[0])
+                        yield RowTask(flag_text[0], '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), is_diff=True)
                         flag_text = [0, [], [],[]]
                         flagg_append(flag_text, text1, text2, number, diff)
                 else:
                     if len(flag_text[1])==1 and flag_text[3][0]:
-                        sequence_matcher(table,flag_text[1][0],flag_text[2][0],count_error,flag_text[0])
+                        yield RowTask(flag_text[0], flag_text[1][0], flag_text[2][0], is_diff=True)
                         flag_text = [0, [], [], []]
                         flagg_append(flag_text, text1, text2, number, diff)
                     else:
@@ -223,13 +170,55 @@ def save_disagreement(file1: str, file2: str, count_error: int, flag: bool, file
 
     else:
         if len(flag_text[1])>0:
-            sequence_matcher(table, '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), count_error, flag_text[0])
+            yield RowTask(flag_text[0], '\n'.join(flag_text[1]), '\n'.join(flag_text[2]), is_diff=True)
+
+
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+
+
+def get_diff_executor() -> Optional[Executor]:
+    """
+    Общий для всех запросов пул процессов, None если DIFF_WORKERS не больше 1. Процессы запускаются через spawn:
+    fork многопоточного сервера мог бы унаследовать блокировку, захваченную другим потоком
+    """
+    global _executor
+    if DIFF_WORKERS <= 1:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(DIFF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def get_disagreement_rows(file1: str, file2: str, count_error: int, flag: bool,
+                          executor: Executor = None) -> Iterator[ReportRow]:
+    """
+    Строки протокола, которые остаются после фильтра count_error, в порядке пунктов.
+    Различия строк считаются в пуле процессов, если он передан, а результаты приходят по порядку
+    """
+    tasks = get_disagreement_row_tasks(file1, file2, count_error, flag)
+    compute = partial(compute_row, count_error=count_error)
+    if executor is None:
+        rows = map(compute, tasks)
+    else:
+        rows = executor.map(compute, tasks, chunksize=DIFF_CHUNK_SIZE)
+    return (row for row in rows if row is not None)
 
 
+def iter_disagreement(file1: str, file2: str, count_error: int, flag: bool, file_name_docx: str,
+                      file_name_pdf: str) -> Iterator[bytes]:
+    """Протокол разногласий в docx кусками, строки таблицы пишутся сразу, как только посчитаны"""
+    logger.info('Create document')
+    rows = get_disagreement_rows(file1, file2, count_error, flag, get_diff_executor())
+    return iter_report(rows, file_name_docx, file_name_pdf)
 
 
+def save_disagreement(file1: str, file2: str, count_error: int, flag: bool, file_name_docx: str, file_name_pdf: str) \
+        -> io.BytesIO:
     file_stream = io.BytesIO()
-    result.save(file_stream)
+    for chunk in iter_disagreement(file1, file2, count_error, flag, file_name_docx, file_name_pdf):
+        file_stream.write(chunk)
     file_stream.seek(0)
 
     return file_stream
@@ -0,0 +1,118 @@
+import io
+import re
+import zipfile
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, List
+from xml.sax.saxutils import escape
+from docx import Document
+from docx.shared import Inches, Length
+
+from difference_between_files.diff_engine import DiffRun
+
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+DOCUMENT_PART = "word/document.xml"
+CELL_WIDTHS = (Inches(0.6), Inches(3), Inches(3))
+HIGHLIGHT_PROPERTIES = '<w:rPr><w:highlight w:val="yellow"/></w:rPr>'
+RUN_BREAKS = re.compile(r"([\t\n\r])")
+
+
+@dataclass
+class ReportRow:
+    """Строка таблицы протокола: номер пункта и куски текста левой и правой колонки"""
+    number: str
+    runs: List[DiffRun] = field(default_factory=list)
+
+
+def get_report_template(file_name_docx: str, file_name_pdf: str) -> bytes:
+    """Пустой протокол с заголовком и шапкой таблицы, строки вписываются в него при записи"""
+    result = Document()
+    result.add_heading("Протокол разногласий")
+    table = result.add_table(rows=1, cols=3)
+    table.style = "TableGrid"
+    table.autofit = False
+    heading_cells = table.rows[0].cells
+    heading_cells[0].text = "№"
+    heading_cells[0].width = CELL_WIDTHS[0]
+    heading_cells[1].text = f"Редакция заказчика\n{file_name_docx}"
+    heading_cells[1].width = CELL_WIDTHS[1]
+    heading_cells[2].text = f"Редакция исполнителя\n{file_name_pdf}"
+    heading_cells[2].width = CELL_WIDTHS[2]
+    file_stream = io.BytesIO()
+    result.save(file_stream)
+    return file_stream.getvalue()
+
+
+def get_run_xml(text: str, highlight: bool = False) -> str:
+    """w:r так же, как его пишет python-docx: табуляции и переводы строк становятся w:tab и w:br"""
+    parts = ["<w:r>", HIGHLIGHT_PROPERTIES if highlight else ""]
+    for piece in RUN_BREAKS.split(text):
+        if piece == "\t":
+            parts.append("<w:tab/>")
+        elif piece in ("\n", "\r"):
+            parts.append("<w:br/>")
+        elif piece:
+            space = ' xml:space="preserve"' if len(piece.strip()) < len(piece) else ""
+            parts.append(f"<w:t{space}>{escape(piece)}</w:t>")
+    if len(parts) == 2 and not highlight:
+        return "<w:r/>"
+    parts.append("</w:r>")
+    return "".join(parts)
+
+
+def get_cell_xml(width: Length, runs_xml: str) -> str:
+    return f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{width.twips}"/></w:tcPr><w:p>{runs_xml}</w:p></w:tc>'
+
+
+def get_row_xml(row: ReportRow) -> str:
+    left_runs = "".join(get_run_xml(run.left, run.left_highlight) for run in row.runs)
+    right_runs = "".join(get_run_xml(run.right, run.right_highlight) for run in row.runs)
+    return "".join(["<w:tr>", get_cell_xml(CELL_WIDTHS[0], get_run_xml(row.number)),
+                    get_cell_xml(CELL_WIDTHS[1], left_runs), get_cell_xml(CELL_WIDTHS[2], right_runs), "</w:tr>"])
+
+
+class ChunkStream(object):
+    """Поток без перемотки для zipfile: копит записанные байты, пока их не заберут"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_report(rows: Iterable[ReportRow], file_name_docx: str, file_name_pdf: str) -> Iterator[bytes]:
+    """
+    Docx протокола кусками по мере записи строк. Все части, кроме document.xml, берутся из шаблона python-docx,
+    а строки таблицы пишутся в document.xml перед закрытием таблицы, по одной
+    """
+    stream = ChunkStream()
+    with zipfile.ZipFile(io.BytesIO(get_report_template(file_name_docx, file_name_pdf))) as template, \
+            zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as report:
+        for item in template.infolist():
+            if item.filename != DOCUMENT_PART:
+                report.writestr(item, template.read(item))
+                yield stream.pop()
+                continue
+            document_xml = template.read(item).decode("utf-8")
+            table_end = document_xml.rindex("</w:tbl>")
+            document_item = zipfile.ZipInfo(item.filename, item.date_time)
+            document_item.compress_type = zipfile.ZIP_DEFLATED
+            with report.open(document_item, "w") as document_part:
+                document_part.write(document_xml[:table_end].encode("utf-8"))
+                for row in rows:
+                    document_part.write(get_row_xml(row).encode("utf-8"))
+                    chunk = stream.pop()
+                    if chunk:
+                        yield chunk
+                document_part.write(document_xml[table_end:].encode("utf-8"))
+            yield stream.pop()
+    yield stream.pop()
@@ -1,20 +1,124 @@
 import re
-import subprocess
-import fuzzywuzzy
+import json
+import hashlib
+import functools
+import threading
+import multiprocessing
 import pdfplumber
+import importlib.metadata
+from concurrent.futures import Executor, ProcessPoolExecutor
 from __init__ import *
-from typing import List
+from cache_index import file_hash
+from extraction_cache import ExtractionCache
+from libreoffice_pool import convert_document, get_libreoffice_version
+from typing import Callable, List, Optional, Set, Tuple
 from docx import Document
-from collections import deque
-from fuzzywuzzy import process
 from docx2python import docx2python
+from docx2python.iterators import iter_at_depth
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
 
 logging.getLogger("pdfminer").setLevel(logging.WARNING)
 
+# Сколько строк pdf после последнего начала абзаца просматривается сразу, полоса удваивается, если совпадения нет
+PARAGRAPH_START_BAND = int(os.environ.get("PARAGRAPH_START_BAND", 64))
+# Дальше этого числа строк после последнего начала абзаца строка docx не ищется
+PARAGRAPH_START_MAX_BAND = int(os.environ.get("PARAGRAPH_START_MAX_BAND", 1024))
+PARAGRAPH_START_MIN_SCORE = float(os.environ.get("PARAGRAPH_START_MIN_SCORE", 60))
+
+# 0 или 1 извлекают текст страниц pdf в текущем процессе
+PDF_EXTRACTION_WORKERS = int(os.environ.get("PDF_EXTRACTION_WORKERS", 0))
+# Меньше страниц на процесс не даётся: открытие pdf в процессе дороже разбора нескольких страниц
+PDF_EXTRACTION_MIN_PAGES = int(os.environ.get("PDF_EXTRACTION_MIN_PAGES", 16))
+
+# layout: абзацы собираются по строкам pdf, отрисованного LibreOffice, paragraphs: прямо из абзацев docx2python
+DOCX_EXTRACTION_MODE = os.environ.get("DOCX_EXTRACTION_MODE", "layout")
+# Документы Word 97-2003 приводятся к docx через LibreOffice в любом режиме
+DOC_MIME_TYPE = "Composite Document File V2 Document"
+
+DOCX_CACHE_DIR = os.environ.get("DOCX_CACHE_DIR", f"{os.environ.get('PATH_DOCUMENTS')}/docx_cache")
+DOCX_CACHE_MAX_SIZE = int(os.environ.get("DOCX_CACHE_MAX_SIZE", 512 * 1024 ** 2))
+# Библиотеки, от которых зависят извлечённые строки: после их обновления старые записи кэша не используются
+# Увеличивается при изменении сборки абзацев, чтобы не отдавать текст, собранный прежним кодом
+DOCX_CACHE_FORMAT_VERSION = 3
+DOCX_CACHE_LIBRARIES = ("docx2python", "python-docx", "pdfplumber", "pdfminer.six", "rapidfuzz")
+
+
+@functools.lru_cache(maxsize=None)
+def get_libraries_versions(with_libreoffice: bool = True) -> str:
+    versions = {}
+    for library in DOCX_CACHE_LIBRARIES:
+        try:
+            versions[library] = importlib.metadata.version(library)
+        except importlib.metadata.PackageNotFoundError:
+            versions[library] = None
+    if with_libreoffice:
+        versions["libreoffice"] = get_libreoffice_version()
+    return json.dumps(versions, sort_keys=True)
+
+
+_docx_cache: Optional[ExtractionCache] = None
+_docx_cache_lock = threading.Lock()
+
+
+def get_docx_cache() -> ExtractionCache:
+    global _docx_cache
+    with _docx_cache_lock:
+        if _docx_cache is None:
+            _docx_cache = ExtractionCache(DOCX_CACHE_DIR, DOCX_CACHE_MAX_SIZE)
+        return _docx_cache
+
+
+_pdf_executor: Optional[Executor] = None
+_pdf_executor_lock = threading.Lock()
+
+
+def get_pdf_executor() -> Optional[Executor]:
+    """
+    Общий для всех документов пул процессов, None если PDF_EXTRACTION_WORKERS не больше 1. Пул создаётся из потока
+    очереди задач, поэтому процессы запускаются через spawn: fork мог бы унаследовать чужую захваченную блокировку
+    """
+    global _pdf_executor
+    if PDF_EXTRACTION_WORKERS <= 1:
+        return None
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            _pdf_executor = ProcessPoolExecutor(PDF_EXTRACTION_WORKERS,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_executor
+
+
+def get_page_lines(page) -> List[str]:
+    return [line.strip() + '\n' for line in page.extract_text().split('\n')]
+
+
+def get_pages_range_lines(path: str, start: int, stop: int) -> List[str]:
+    """Строки страниц [start, stop) pdf, процесс пула открывает файл сам"""
+    lines = []
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages[start:stop]:
+            lines.extend(get_page_lines(page))
+    return lines
+
+
+def get_pages_ranges(total_pages: int, count: int) -> List[Tuple[int, int]]:
+    """count подряд идущих диапазонов страниц, размеры которых отличаются не больше чем на одну страницу"""
+    size, rest = divmod(total_pages, count)
+    ranges = []
+    start = 0
+    for number in range(count):
+        stop = start + size + (number < rest)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
 
 class Docx(object):
-    def __init__(self, absolute_path_filename: str):
+    def __init__(self, absolute_path_filename: str,
+                 report_progress: Callable[[str, Optional[float]], None] = None, content_id: str = None):
         self.absolute_path_filename: str = absolute_path_filename
+        self.content_id: Optional[str] = content_id
+        self.report_progress: Callable[[str, Optional[float]], None] = report_progress or (lambda *args: None)
 
     @staticmethod
     def clean_special_chars(lst: List[str]) -> List[str]:
@@ -23,47 +127,71 @@ class Docx(object):
         return lst
 
     @staticmethod
-    def get_paragraph_starts(docx_text: List[str], pdf_text: List[str]) -> List[int]:
-        # index_paragraph = 0
-        # p_starts = set()
-        p_starts = deque([0, 0, 0])
-        for dl in docx_text:
-            if len(dl) < 3:
+    def find_paragraph_start(prefix: str, pdf_lines: List[str], anchor: int,
+                             max_band: int = PARAGRAPH_START_MAX_BAND) -> Optional[int]:
+        """
+        Первая из лучших строк pdf не раньше anchor, похожая на prefix. Сначала ищем в полосе PARAGRAPH_START_BAND
+        строк, пока совпадения не лучше PARAGRAPH_START_MIN_SCORE, продолжаем в следующей полосе вдвое шире,
+        но не дальше max_band строк от anchor
+        """
+        start, band = anchor, PARAGRAPH_START_BAND
+        stop = min(anchor + max_band, len(pdf_lines))
+        while start < stop:
+            end = min(start + band, stop)
+            match = process.extractOne(prefix, pdf_lines[start:end], scorer=fuzz.ratio, processor=None,
+                                       score_cutoff=PARAGRAPH_START_MIN_SCORE)
+            if match is not None:
+                return start + match[2]
+            start, band = end, band * 2
+        return None
+
+    def get_paragraph_starts(self, docx_text: List[str], pdf_text: List[str]) -> Set[int]:
+        """
+        Номера строк pdf, с которых начинаются абзацы docx. Начала ищутся по порядку, каждое не раньше прошлого.
+        Совпадение дальше первой полосы принимается, только если следующая строка docx находится в полосе после него,
+        иначе строка, которой нет в pdf, уводила бы поиск к похожей строке в конце документа
+        """
+        pdf_lines = [default_process(pl) for pl in pdf_text]
+        prefixes = [default_process(dl[:min(70, len(dl))]) for dl in docx_text if len(dl) >= 3]
+        prefixes = [prefix for prefix in prefixes if prefix]
+        p_starts = {0}
+        anchor = 0
+        for i, prefix in enumerate(prefixes):
+            new_index = self.find_paragraph_start(prefix, pdf_lines, anchor)
+            if new_index is None:
+                continue
+            if new_index - anchor >= PARAGRAPH_START_BAND and (
+                    i + 1 == len(prefixes) or
+                    self.find_paragraph_start(prefixes[i + 1], pdf_lines, new_index + 1, PARAGRAPH_START_BAND) is None
+            ):
                 continue
-            i = min(70, len(dl))
-            prefix = dl[:i]
-            # pls = process.extract(prefix, pdf_text[index_paragraph:], limit=1)
-            pls = fuzzywuzzy.process.extract(prefix,
-                                             pdf_text[p_starts[-3]:],
-                                             scorer=fuzzywuzzy.fuzz.ratio,
-                                             limit=3)
-            pl = pls[0][0]
-            new_index = pdf_text.index(pl)
-            p_starts.append(new_index)
-        return sorted(set(p_starts))
-        #     index_paragraph = pdf_text.index(pl)
-        #     p_starts.add(index_paragraph)
-        # return sorted(p_starts)
+            anchor = new_index
+            p_starts.add(new_index)
+        return p_starts
 
     def save_txt(self, paragraphs):
         path = os.path.join(os.path.dirname(self.absolute_path_filename), "paragraphs.txt")
         with open(path, "w") as f:
             f.writelines(paragraphs)
 
+    @staticmethod
+    def join_paragraph_lines(lines: List[str]) -> str:
+        """Строки абзаца через пробел, перевод строки остаётся только у последней"""
+        return "".join(line.replace("\n", " ") for line in lines[:-1]) + lines[-1]
+
     def format_paragraphs(self, docx_text: List[str], pdf_text: List[str]) -> str:
         docx_text = self.clean_special_chars(docx_text)
         pdf_text = self.clean_special_chars(pdf_text)
         p_starts = self.get_paragraph_starts(docx_text, pdf_text)
         paragraphs = []
-        current_paragraph = ''
+        current_lines = []
         for i, pl in enumerate(pdf_text):
-            if i in p_starts:
-                if current_paragraph:
-                    paragraphs.append(current_paragraph)
-                current_paragraph = pl
-            else:
-                current_paragraph = current_paragraph.replace("\n", " ")
-                current_paragraph += pl
+            if i in p_starts and current_lines:
+                paragraphs.append(self.join_paragraph_lines(current_lines))
+                current_lines = []
+            current_lines.append(pl)
+        if current_lines:
+            paragraphs.append(self.join_paragraph_lines(current_lines))
         self.save_txt(paragraphs)
         return "".join(paragraphs)
 
@@ -75,24 +203,107 @@ class Docx(object):
             doc.save(self.absolute_path_filename)
 
     def convert_to_docx(self) -> None:
-        subprocess.check_output(['libreoffice', '--convert-to', 'docx', self.absolute_path_filename, '--outdir',
-                                 os.path.dirname(self.absolute_path_filename)])
+        convert_document(self.absolute_path_filename, "docx")
         self.absolute_path_filename += 'x'
 
+    def get_cache_keys(self, with_libreoffice: bool = True) -> Tuple[str, str]:
+        """
+        Ключи кэша строк docx и pdf и итогового текста из одной основы: хеш содержимого, посчитанный при загрузке,
+        и версии библиотек. Для итогового текста к ней добавляются режим извлечения и настройки поиска абзацев
+        """
+        content_id = self.content_id or file_hash(self.absolute_path_filename)
+        lines_key = hashlib.sha256(f"{content_id}:{get_libraries_versions(with_libreoffice)}".encode())
+        text_key = lines_key.copy()
+        text_key.update(f":{DOCX_CACHE_FORMAT_VERSION}:{DOCX_EXTRACTION_MODE}:{PARAGRAPH_START_BAND}:"
+                        f"{PARAGRAPH_START_MAX_BAND}:{PARAGRAPH_START_MIN_SCORE}".encode())
+        return f"lines-{lines_key.hexdigest()}", f"text-{text_key.hexdigest()}"
+
+    @staticmethod
+    def get_docx_paragraphs(docx_text) -> List[str]:
+        """
+        Абзацы из дерева docx2python: колонтитулы, таблицы и сноски разворачиваются в абзацы по порядку,
+        нумерация остаётся в начале абзаца. Перевод строки внутри абзаца делит его, как и в режиме layout
+        """
+        lines = (line.replace("\t", " ") for paragraph in iter_at_depth(docx_text.document, 4)
+                 for line in paragraph.split("\n"))
+        paragraphs = [line.strip() for line in Docx.clean_special_chars(lines)]
+        return [paragraph + "\n" for paragraph in paragraphs if paragraph]
+
+    def get_paragraphs_text(self, mime_type) -> str:
+        """Текст документа по абзацам docx без отрисовки в pdf, LibreOffice нужен только для doc"""
+        docx_cache: ExtractionCache = get_docx_cache()
+        is_doc = DOC_MIME_TYPE in mime_type
+        _, text_key = self.get_cache_keys(is_doc)
+        text: Optional[str] = docx_cache.get(text_key)
+        if text is not None:
+            logger.info(f"Text of {self.absolute_path_filename} is taken from cache")
+            return text
+        if is_doc:
+            self.report_progress("conversion")
+            self.convert_to_docx()
+        self.report_progress("paragraphs")
+        paragraphs = self.get_docx_paragraphs(docx2python(self.absolute_path_filename))
+        self.save_txt(paragraphs)
+        text = "".join(paragraphs)
+        docx_cache.put(text_key, text)
+        return text
+
     def get_text(self, mime_type) -> str:
-        if "Composite Document File V2 Document" in mime_type:
+        """Текст документа по абзацам. Уже обработанный документ берётся из кэша, строки docx и pdf тоже кэшируются"""
+        if DOCX_EXTRACTION_MODE == "paragraphs":
+            return self.get_paragraphs_text(mime_type)
+        docx_cache: ExtractionCache = get_docx_cache()
+        lines_key, text_key = self.get_cache_keys()
+        text: Optional[str] = docx_cache.get(text_key)
+        if text is not None:
+            logger.info(f"Text of {self.absolute_path_filename} is taken from cache")
+            return text
+        lines: Optional[str] = docx_cache.get(lines_key)
+        if lines is None:
+            list_docx_text, list_pdf_text = self.extract_lines(mime_type)
+            docx_cache.put(lines_key, json.dumps({"list_docx_text": list_docx_text, "list_pdf_text": list_pdf_text},
+                                                 ensure_ascii=False))
+        else:
+            logger.info(f"Lines of {self.absolute_path_filename} are taken from cache")
+            lines_dict = json.loads(lines)
+            list_docx_text, list_pdf_text = lines_dict["list_docx_text"], lines_dict["list_pdf_text"]
+        self.report_progress("paragraphs")
+        text = self.format_paragraphs(list_docx_text, list_pdf_text)
+        docx_cache.put(text_key, text)
+        return text
+
+    def extract_pdf_lines(self, path: str, executor: Executor = None) -> List[str]:
+        """
+        Строки pdf по страницам. Если есть пул процессов и страниц хватает хотя бы на два процесса
+        по PDF_EXTRACTION_MIN_PAGES, диапазоны страниц разбираются параллельно и склеиваются по порядку
+        """
+        executor = executor or get_pdf_executor()
+        list_pdf_text = []
+        with pdfplumber.open(path) as pdf:
+            total_pages = len(pdf.pages)
+            workers = min(PDF_EXTRACTION_WORKERS, total_pages // PDF_EXTRACTION_MIN_PAGES)
+            if executor is None or workers <= 1:
+                for number, page in enumerate(pdf.pages):
+                    self.report_progress("extraction", number / total_pages)
+                    list_pdf_text.extend(get_page_lines(page))
+                return list_pdf_text
+        ranges = get_pages_ranges(total_pages, workers)
+        starts, stops = zip(*ranges)
+        for (_, stop), lines in zip(ranges, executor.map(get_pages_range_lines, [path] * workers, starts, stops)):
+            list_pdf_text.extend(lines)
+            self.report_progress("extraction", stop / total_pages)
+        return list_pdf_text
+
+    def extract_lines(self, mime_type) -> Tuple[List[str], List[str]]:
+        self.report_progress("conversion")
+        if DOC_MIME_TYPE in mime_type:
             self.convert_to_docx()
         # self.refactor_page_header(True)
         docx_text = docx2python(self.absolute_path_filename)
-        subprocess.check_output(['libreoffice', '--convert-to', 'pdf', self.absolute_path_filename, '--outdir',
-                                 os.path.dirname(self.absolute_path_filename)])
-        texts = pdfplumber.open(self.absolute_path_filename.replace(".docx", ".pdf"))
-        list_pdf_text = []
-        for text in texts.pages:
-            list_pdf_text.extend(line.strip() + '\n' for line in text.extract_text().split('\n'))
+        list_pdf_text = self.extract_pdf_lines(convert_document(self.absolute_path_filename, "pdf"))
         list_docx_text = [line.strip() + '\n' for line in docx_text.text.split('\n')]
         with open(f"{os.path.dirname(self.absolute_path_filename)}/list_pdf_text.txt", "w") as f:
             f.writelines(list_pdf_text)
         with open(f"{os.path.dirname(self.absolute_path_filename)}/list_docx_text.txt", "w") as f:
             f.writelines(list_docx_text)
-        return self.format_paragraphs(list_docx_text, list_pdf_text)
+        return list_docx_text, list_pdf_text
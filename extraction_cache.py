@@ -0,0 +1,40 @@
+import uuid
+import contextlib
+from __init__ import *
+from cache_index import CacheIndex, get_cache_index
+from typing import Optional
+
+
+class ExtractionCache(object):
+    """Текст, извлечённый из документа, по ключу из хеша содержимого документа. Лишнее удаляется CacheIndex"""
+
+    def __init__(self, directory: str, max_size: int):
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self.index: CacheIndex = get_cache_index(f"{directory}/cache_index.sqlite3", max_size)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(directory={self.directory})'
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.index.get(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, text: str) -> None:
+        path = os.path.join(self.directory, f"{key}.txt")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+        self.index.put(key, path)
+
@@ -0,0 +1,93 @@
+import time
+import uuid
+import threading
+from __init__ import *
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_TTL = float(os.environ.get("JOB_TTL", 3600))
+
+
+class Job(object):
+    """Обработка одного загруженного документа: этап, прогресс и результат"""
+
+    def __init__(self):
+        self.id: str = uuid.uuid4().hex
+        self.status: str = "queued"
+        self.stage: str = "queued"
+        self.progress: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(id={self.id}, status={self.status}, stage={self.stage})'
+
+    def report(self, stage: str, progress: Optional[float] = None) -> None:
+        self.stage = stage
+        self.progress = progress
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error
+        }
+
+
+class JobQueue(object):
+    """Пул потоков, который обрабатывает документы вне HTTP-запроса"""
+
+    def __init__(self, workers: int = JOB_WORKERS, ttl: float = JOB_TTL):
+        self.ttl: float = ttl
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs: Dict[str, Job] = {}
+        self._keys: Dict[str, str] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def submit(self, func: Callable, *args, key: str = None) -> Job:
+        """
+        func получает задачу первым аргументом, чтобы сообщать этап через job.report. Пока задача с тем же key
+        известна и не завершилась ошибкой, возвращается она, а вторая не запускается
+        """
+        with self._lock:
+            self._remove_expired()
+            if key is not None and key in self._keys:
+                job = self._jobs[self._keys[key]]
+                if job.status != "error":
+                    return job
+            job = Job()
+            self._jobs[job.id] = job
+            if key is not None:
+                self._keys[key] = job.id
+        self._executor.submit(self._run, job, func, args)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    @staticmethod
+    def _run(job: Job, func: Callable, args: tuple) -> None:
+        job.status = "running"
+        try:
+            job.result = func(job, *args)
+            job.report("done", 1.0)
+            job.status = "done"
+        except Exception as ex:
+            logger.exception(f"{job} failed: {ex}")
+            job.error = str(ex)
+            job.status = "error"
+        job.finished_at = time.time()
+
+    def _remove_expired(self) -> None:
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+        self._keys = {key: job_id for key, job_id in self._keys.items() if job_id in self._jobs}
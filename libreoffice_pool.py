@@ -0,0 +1,238 @@
+import time
+import queue
+import atexit
+import shutil
+import socket
+import functools
+import signal
+import tempfile
+import threading
+import subprocess
+from __init__ import *
+from typing import Any, List, Optional
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+except ImportError:
+    uno = None
+
+LIBREOFFICE_BINARY = os.environ.get("LIBREOFFICE_BINARY", "soffice")
+LIBREOFFICE_POOL_SIZE = int(os.environ.get("LIBREOFFICE_POOL_SIZE", 2))
+LIBREOFFICE_PORT = int(os.environ.get("LIBREOFFICE_PORT", 2002))
+LIBREOFFICE_TIMEOUT = float(os.environ.get("LIBREOFFICE_TIMEOUT", 300))
+LIBREOFFICE_START_TIMEOUT = float(os.environ.get("LIBREOFFICE_START_TIMEOUT", 60))
+
+FILTERS = {
+    "pdf": "writer_pdf_Export",
+    "docx": "MS Word 2007 XML",
+}
+
+
+def is_port_free(port: int) -> bool:
+    with socket.socket() as sock:
+        try:
+            sock.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+        return True
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_properties(**kwargs) -> tuple:
+    properties = []
+    for name, value in kwargs.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        properties.append(prop)
+    return tuple(properties)
+
+
+class LibreOfficeInstance(object):
+    """
+    Запущенный в фоне soffice со своим профилем, принимающий задания на конвертацию по UNO.
+    Профиль создаётся заново при каждом запуске, а занятый порт заменяется свободным: иначе новый soffice
+    передаст работу оставшемуся от прошлого процесса сервера и сразу завершится
+    """
+
+    def __init__(self, number: int):
+        self.number: int = number
+        self.port: int = LIBREOFFICE_PORT + number
+        self.profile_dir: Optional[str] = None
+        self.process: Optional[subprocess.Popen] = None
+        self.desktop: Any = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(number={self.number}, port={self.port})'
+
+    def start(self) -> None:
+        if not is_port_free(self.port):
+            port = get_free_port()
+            logger.warning(f"Port {self.port} of {self} is taken, maybe by soffice of previous run, using {port}")
+            self.port = port
+        self.profile_dir = tempfile.mkdtemp(prefix=f"libreoffice_profile_{self.number}_")
+        logger.info(f"Starting {self}")
+        self.process = subprocess.Popen(
+            [LIBREOFFICE_BINARY, "--headless", "--invisible", "--nologo", "--nodefault", "--norestore",
+             "--nolockcheck", f"-env:UserInstallation=file://{self.profile_dir}",
+             f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        deadline = time.monotonic() + LIBREOFFICE_START_TIMEOUT
+        while True:
+            try:
+                self.desktop = self._connect()
+                return
+            except NoConnectException:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"{self} didn't start in {LIBREOFFICE_START_TIMEOUT} seconds")
+                time.sleep(0.5)
+
+    def _connect(self) -> Any:
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        context = resolver.resolve(f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext")
+        return context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+
+    def stop(self) -> None:
+        self.desktop = None
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.wait()
+            self.process = None
+        if self.profile_dir is not None:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+    def is_alive(self) -> bool:
+        if self.process is None or self.process.poll() is not None or self.desktop is None:
+            return False
+        try:
+            self.desktop.getComponents()
+        except Exception as ex:
+            logger.warning(f"{self} doesn't respond: {ex}")
+            return False
+        return True
+
+    def convert(self, source: str, target: str, filter_name: str) -> None:
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(source)), "_blank", 0, get_properties(Hidden=True)
+        )
+        try:
+            document.storeToURL(uno.systemPathToFileUrl(os.path.abspath(target)),
+                                get_properties(FilterName=filter_name))
+        finally:
+            document.close(True)
+
+
+class LibreOfficePool(object):
+    """
+    Пул постоянно запущенных LibreOffice. Экземпляр проверяется перед каждым заданием
+    и перезапускается, если процесс упал или завис дольше LIBREOFFICE_TIMEOUT.
+    """
+
+    def __init__(self, size: int = LIBREOFFICE_POOL_SIZE):
+        self.instances: List[LibreOfficeInstance] = [LibreOfficeInstance(number) for number in range(size)]
+        self._idle: queue.Queue = queue.Queue()
+        for instance in self.instances:
+            self._idle.put(instance)
+
+    def convert(self, source: str, target: str, filter_name: str, timeout: float = LIBREOFFICE_TIMEOUT) -> None:
+        try:
+            instance: LibreOfficeInstance = self._idle.get(timeout=timeout)
+        except queue.Empty as ex:
+            raise TimeoutError(f"No free LibreOffice instance in {timeout} seconds") from ex
+        try:
+            if not instance.is_alive():
+                instance.stop()
+                instance.start()
+            self._convert_with_timeout(instance, source, target, filter_name, timeout)
+        finally:
+            self._idle.put(instance)
+
+    @staticmethod
+    def _convert_with_timeout(instance: LibreOfficeInstance, source: str, target: str, filter_name: str,
+                              timeout: float) -> None:
+        errors = []
+
+        def convert():
+            try:
+                instance.convert(source, target, filter_name)
+            except Exception as ex:
+                errors.append(ex)
+
+        thread = threading.Thread(target=convert, name=f"libreoffice_{instance.number}", daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.error(f"{instance} hung on {source}, killing it")
+            instance.stop()
+            raise TimeoutError(f"Conversion of {source} is not finished in {timeout} seconds")
+        if errors:
+            instance.stop()
+            raise errors[0]
+
+    def close(self) -> None:
+        for instance in self.instances:
+            instance.stop()
+
+
+_pool: Optional[LibreOfficePool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> LibreOfficePool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = LibreOfficePool()
+        return _pool
+
+
+@atexit.register
+def close_pool() -> None:
+    """
+    Останавливает все soffice пула. Они запущены в своих сессиях и не завершаются вместе с сервером,
+    поэтому перед перезапуском через os.execv, при котором atexit не срабатывает, close_pool вызывается явно
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_libreoffice_version() -> Optional[str]:
+    """Версия LibreOffice, которым конвертируются документы, None если её не удалось узнать"""
+    binary = LIBREOFFICE_BINARY if uno is not None else "libreoffice"
+    try:
+        return subprocess.check_output([binary, "--version"], timeout=LIBREOFFICE_START_TIMEOUT).decode().strip()
+    except (OSError, subprocess.SubprocessError) as ex:
+        logger.warning(f"Can't get LibreOffice version: {ex}")
+        return None
+
+
+def convert_document(source: str, extension: str, timeout: float = LIBREOFFICE_TIMEOUT) -> str:
+    """Конвертирует документ в формат extension и кладёт результат рядом с исходным файлом"""
+    outdir = os.path.dirname(source)
+    target = os.path.join(outdir, f"{os.path.splitext(os.path.basename(source))[0]}.{extension}")
+    if uno is None:
+        subprocess.check_output(['libreoffice', '--convert-to', extension, source, '--outdir', outdir],
+                                timeout=timeout)
+    else:
+        get_pool().convert(source, target, FILTERS[extension], timeout)
+    return target
@@ -1,18 +1,25 @@
 import sys
+import json
 import time
 import magic
 from pdf_ import PDF
 from docx_ import Docx
+from jobs import Job, JobQueue
+from chunk_upload import ChunkedUpload
+from libreoffice_pool import close_pool
 from __init__ import *
-from typing import Union, Tuple
+from typing import Optional
 from werkzeug.datastructures import FileStorage
 from unified.split_scanned_by_paragraph import *
-from difference_between_files.difference import save_disagreement
-from flask import render_template, request, jsonify, Response, make_response
+from difference_between_files.difference import iter_disagreement
+from difference_between_files.report_writer import DOCX_MIMETYPE
+from report_cache import get_report_cache, report_key
+from flask import render_template, request, jsonify, Response, make_response, stream_with_context, send_file
 
 
 # Флаг для определения необходимости перезапуска
 restart_flag = False
+job_queue: JobQueue = JobQueue()
 
 
 @app.get("/")
@@ -20,55 +27,112 @@ def index() -> str:
     return render_template("index.html")
 
 
-def join_chunks_in_file(file, absolute_path_filename) -> Response:
-    current_chunk = int(request.form['dzchunkindex'])
-    if os.path.exists(absolute_path_filename) and current_chunk == 0:
-        return make_response(('File already exists', 400))
+def get_target_path(filename: str, content_id: str) -> str:
+    """Документы хранятся под хешем содержимого, поэтому одинаковые файлы с разными именами лежат один раз"""
+    filename = os.path.basename(filename)
+    extension = os.path.splitext(filename)[1].lower()
+    if filename.split(".")[1] == 'docx':
+        return f"{dir_name_docx}/{content_id}{extension}"
+    return f"{dir_name_pdf}/{content_id}{extension}"
+
+
+def process_document(job: Job, absolute_path_filename: str, file: FileStorage, content_id: str = None) -> str:
+    """
+    Текст документа. Хеш содержимого, посчитанный при загрузке, передаётся дальше: по нему PDF находит готовый
+    результат OCR, а Docx строит ключ кэша вместе с версиями библиотек и настройками извлечения
+    """
+    job.report("sniffing")
+    mime_type: str = magic.Magic().from_file(absolute_path_filename)
+    if "PDF" in mime_type:
+        pdf: PDF = PDF(file, absolute_path_filename, job.report, content_id)
+        return pdf.get_text()
+    docx_types = ["Microsoft Word", "Composite Document File V2 Document", "Microsoft OOXML"]
+    if any(docx_type in mime_type for docx_type in docx_types):
+        docx: Docx = Docx(absolute_path_filename, job.report, content_id)
+        return docx.get_text(mime_type)
+    raise ValueError("Ошибка. Вы загрузили не поддерживаемый подтип файла или файл поврежден.")
+
+
+@app.post("/upload")
+def upload() -> Response:
+    file: FileStorage = request.files['file']
     try:
-        with open(absolute_path_filename, 'ab') as f:
-            f.seek(int(request.form['dzchunkbyteoffset']))
-            f.write(file.stream.read())
+        chunked_upload: ChunkedUpload = ChunkedUpload(request.form['dzuuid'])
+        status: dict = chunked_upload.write_chunk(
+            int(request.form['dzchunkindex']), int(request.form['dzchunkbyteoffset']), file.stream,
+            int(request.form['dztotalfilesize']), int(request.form['dztotalchunkcount']),
+            int(request.form['dzchunksize'])
+        )
+    except ValueError as ex:
+        return make_response((str(ex), 400))
     except OSError:
         return make_response(("Not sure why,"
                               " but we couldn't write the file to disk", 500))
-    total_chunks = int(request.form['dztotalchunkcount'])
-    if current_chunk + 1 == total_chunks and os.path.getsize(absolute_path_filename) != \
-            int(request.form['dztotalfilesize']):
-        return make_response(('Size mismatch', 500))
+    return jsonify(status)
 
 
-def get_file_path() -> Tuple[FileStorage, str]:
-    file: FileStorage = request.files['file']
-    filename: str = file.filename
-    if filename.split(".")[1] == 'docx':
-        absolute_path_filename: str = f"{dir_name_docx}/{file.filename}"
-    else:
-        absolute_path_filename = f"{dir_name_pdf}/{file.filename}"
-    return file, absolute_path_filename
+@app.get("/upload/<upload_id>")
+def get_upload(upload_id: str) -> Response:
+    """Какие куски уже получены, чтобы продолжить прерванную загрузку"""
+    try:
+        return jsonify(ChunkedUpload(upload_id).get_status())
+    except ValueError as ex:
+        return make_response((str(ex), 400))
 
 
-@app.post("/upload")
-def upload() -> Union[Response, str]:
-    file, absolute_path_filename = get_file_path()
-    join_chunks_in_file(file, absolute_path_filename)
-    if request.content_length < 250800:
-        mime_type: str = magic.Magic().from_file(absolute_path_filename)
-        if "PDF" in mime_type:
-            pdf: PDF = PDF(file, absolute_path_filename)
-            return pdf.main()
-        docx_types = ["Microsoft Word", "Composite Document File V2 Document", "Microsoft OOXML"]
-        if any(docx_type in mime_type for docx_type in docx_types):
-            docx: Docx = Docx(absolute_path_filename)
-            return docx.get_text(mime_type)
-        raise "Ошибка. Вы загрузили не поддерживаемый подтип файла или файл поврежден."
-    return absolute_path_filename
+@app.post("/upload/<upload_id>/complete")
+def complete_upload(upload_id: str) -> Response:
+    """Запускает обработку, когда получены все куски. Повторный вызов возвращает ту же задачу"""
+    filename: str = os.path.basename(request.json["filename"])
+
+    def submit_job(absolute_path_filename: str, content_id: str) -> str:
+        # Одинаковые файлы, загруженные почти одновременно, лежат по одному пути: их обрабатывает одна задача
+        stored_file = FileStorage(filename=os.path.basename(absolute_path_filename))
+        return job_queue.submit(process_document, absolute_path_filename, stored_file, content_id, key=content_id).id
+
+    try:
+        job_id: Optional[str] = ChunkedUpload(upload_id).complete(
+            lambda content_id: get_target_path(filename, content_id), submit_job,
+            lambda known_job_id: job_queue.get(known_job_id) is not None
+        )
+    except ValueError as ex:
+        return make_response((str(ex), 400))
+    if job_id is None:
+        return make_response(("Not all chunks are uploaded", 409))
+    return jsonify({"job_id": job_id})
+
+
+@app.get("/jobs/<job_id>")
+def get_job(job_id: str) -> Response:
+    job: Optional[Job] = job_queue.get(job_id)
+    if job is None:
+        return make_response(("Job not found", 404))
+    return jsonify(job.to_dict())
 
 
 @app.post("/get_disagreement/")
 def get_disagreement():
     response = request.json
-    return save_disagreement(response["docx"], response["pdf"], response["countError"], response["group_paragraph"],
-                             response["file_name_docx"], response["file_name_pdf"])
+    args = (response["docx"], response["pdf"], response["countError"], response["group_paragraph"],
+            response["file_name_docx"], response["file_name_pdf"])
+    report_cache = get_report_cache()
+    key = report_key(*args)
+    cached_report = report_cache.get(key)
+    if cached_report is not None:
+        logger.info(f"Report {key} is taken from cache")
+        return send_file(cached_report, mimetype=DOCX_MIMETYPE)
+    report = report_cache.write_through(key, iter_disagreement(*args))
+    return Response(stream_with_context(report), mimetype=DOCX_MIMETYPE)
+
+
+def get_unified_chapters(left_text: list, right_text: list, max_thr):
+    """Пары выровненных глав построчно в NDJSON, как только последний этап их закончит"""
+    try:
+        for left_chapter, right_chapter in iter_main(left_text, right_text, max_thr):
+            yield json.dumps({"docx": left_chapter, "pdf": right_chapter}, ensure_ascii=False) + "\n"
+    except Exception as ex:
+        logger.exception(f"Unified failed: {ex}")
+        yield json.dumps({"error": str(ex)}, ensure_ascii=False) + "\n"
 
 
 @app.post("/unified/")
@@ -77,6 +141,9 @@ def get_unified_data():
     max_thr = response["threshold"]
     left_text = response["docx"].split("\n")
     right_text = response["pdf"].split("\n")
+    if response.get("stream"):
+        return Response(stream_with_context(get_unified_chapters(left_text, right_text, max_thr)),
+                        mimetype="application/x-ndjson")
     left_final, right_final = main(left_text, right_text, max_thr)
     dict_data = {
         "docx": left_final,
@@ -89,6 +156,7 @@ def get_unified_data():
 def restart():
     global restart_flag
     restart_flag = True
+    close_pool()
     # Осуществляем перезапуск Flask-приложения
     os.execv(sys.executable, [sys.executable] + sys.argv)
 
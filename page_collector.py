@@ -0,0 +1,170 @@
+import re
+import time
+import struct
+import ctypes
+import threading
+import ctypes.util
+from __init__ import *
+from typing import Callable, Dict, List, Optional
+
+# Флаги inotify (см. <sys/inotify.h>): файл страницы закрыт после записи или перемещён в каталог
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct("iIII")
+
+OCR_TIMEOUT = float(os.environ.get("OCR_TIMEOUT", 3600))
+OCR_POLL_INTERVAL = float(os.environ.get("OCR_POLL_INTERVAL", 2))
+
+
+def get_page_index(name: str) -> Optional[int]:
+    """Номер страницы из имени файла вида <имя>.pdf<...номер...>.txt"""
+    parts = re.split("[.]pdf", name, maxsplit=1)
+    if len(parts) < 2:
+        return None
+    numbers = re.findall(r'\d{1,5}', parts[1])
+    return int(numbers[0]) if numbers else None
+
+
+class PageWaiter(object):
+    """Страницы одного PDF, которые ещё ждут окончания распознавания"""
+
+    def __init__(self, file: str, total_pages: int, on_page: Callable[[int], None] = None):
+        self.file: str = file
+        self.total_pages: int = total_pages
+        self.on_page: Optional[Callable[[int], None]] = on_page
+        self.pages: Dict[int, str] = {}
+        self.done: threading.Event = threading.Event()
+        self._lock: threading.Lock = threading.Lock()
+
+    def offer(self, directory: str, name: str) -> None:
+        if self.file not in name:
+            return
+        page_index = get_page_index(name)
+        if page_index is None:
+            logger.warning(f"Can't get page number from file {name}")
+            return
+        with self._lock:
+            is_new_page = page_index not in self.pages
+            self.pages[page_index] = os.path.join(directory, name)
+            ready_pages = len(self.pages)
+            if ready_pages >= self.total_pages:
+                self.done.set()
+        if is_new_page and self.on_page is not None:
+            self.on_page(ready_pages)
+
+    def get_filenames(self) -> List[str]:
+        with self._lock:
+            return [self.pages[page_index] for page_index in sorted(self.pages)]
+
+
+class PageCollector(object):
+    """
+    Один наблюдатель за каталогом с постраничными результатами OCR на все ожидающие PDF.
+    Использует inotify, а если он недоступен - опрашивает каталог раз в OCR_POLL_INTERVAL секунд.
+    """
+
+    def __init__(self, directory: str, poll_interval: float = OCR_POLL_INTERVAL):
+        self.directory: str = directory
+        self.poll_interval: float = poll_interval
+        self._waiters: List[PageWaiter] = []
+        self._lock: threading.Lock = threading.Lock()
+        self._has_waiters: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def wait_for_pages(self, file: str, total_pages: int, timeout: float = OCR_TIMEOUT,
+                       on_page: Callable[[int], None] = None) -> List[str]:
+        waiter = PageWaiter(file, total_pages, on_page)
+        with self._lock:
+            self._waiters.append(waiter)
+            self._has_waiters.set()
+            self._start()
+        try:
+            # Страницы, которые OCR успел записать до регистрации ожидающего
+            self._scan([waiter])
+            if not waiter.done.wait(timeout):
+                raise TimeoutError(f"OCR of {file} is not finished in {timeout} seconds: "
+                                   f"{len(waiter.pages)} of {total_pages} pages are ready")
+        finally:
+            with self._lock:
+                self._waiters.remove(waiter)
+                if not self._waiters:
+                    self._has_waiters.clear()
+        return waiter.get_filenames()
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        inotify_fd = self._init_inotify()
+        if inotify_fd is None:
+            logger.info(f"inotify is not available, polling {self.directory} every {self.poll_interval} s")
+            target, args = self._poll, ()
+        else:
+            target, args = self._watch, (inotify_fd,)
+        self._thread = threading.Thread(target=target, args=args, name="page_collector", daemon=True)
+        self._thread.start()
+
+    def _dispatch(self, name: str) -> None:
+        with self._lock:
+            waiters = list(self._waiters)
+        for waiter in waiters:
+            waiter.offer(self.directory, name)
+
+    def _scan(self, waiters: List[PageWaiter]) -> None:
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    for waiter in waiters:
+                        waiter.offer(self.directory, entry.name)
+
+    def _init_inotify(self) -> Optional[int]:
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            return None
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            inotify_fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return None
+        if inotify_fd < 0:
+            return None
+        watch_descriptor = libc.inotify_add_watch(inotify_fd, os.fsencode(self.directory),
+                                                  IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch_descriptor < 0:
+            os.close(inotify_fd)
+            return None
+        return inotify_fd
+
+    def _watch(self, inotify_fd: int) -> None:
+        while True:
+            buffer = os.read(inotify_fd, 64 * 1024)
+            offset = 0
+            while offset < len(buffer):
+                _, _, _, name_length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                name = buffer[offset:offset + name_length].rstrip(b"\0")
+                offset += name_length
+                if name:
+                    self._dispatch(os.fsdecode(name))
+
+    def _poll(self) -> None:
+        while True:
+            self._has_waiters.wait()
+            with self._lock:
+                waiters = list(self._waiters)
+            try:
+                self._scan(waiters)
+            except OSError as ex:
+                logger.error(f"Can't scan {self.directory}: {ex}")
+            time.sleep(self.poll_interval)
+
+
+_collectors: Dict[str, PageCollector] = {}
+_collectors_lock = threading.Lock()
+
+
+def get_page_collector(directory: str) -> PageCollector:
+    directory = os.path.abspath(directory)
+    with _collectors_lock:
+        if directory not in _collectors:
+            _collectors[directory] = PageCollector(directory)
+        return _collectors[directory]
@@ -1,21 +1,25 @@
-import re
 import json
-import glob
 import shutil
 import pikepdf
-import enchant
-import contextlib
 from __init__ import *
+from page_collector import get_page_collector
+from spellcheck_filter import filter_file
+from cache_index import CacheIndex, file_hash, get_cache_index
 from pathlib import Path
-from typing import TextIO, Tuple
+from typing import Callable, Optional, TextIO, Tuple
 from flask import Response, jsonify
 from werkzeug.datastructures import FileStorage
 
+OCR_CACHE_MAX_SIZE = int(os.environ.get("OCR_CACHE_MAX_SIZE", 20 * 1024 ** 3))
+
 
 class PDF(object):
-    def __init__(self, file: FileStorage, absolute_path_filename: str):
+    def __init__(self, file: FileStorage, absolute_path_filename: str,
+                 report_progress: Callable[[str, Optional[float]], None] = None, content_id: str = None):
         self.file: FileStorage = file
         self.absolute_path_filename: str = absolute_path_filename
+        self.content_id: Optional[str] = content_id
+        self.report_progress: Callable[[str, Optional[float]], None] = report_progress or (lambda *args: None)
 
     @staticmethod
     def concatenate_files(file_name: str, filenames: list) -> TextIO:
@@ -38,25 +42,15 @@ class PDF(object):
 
     @staticmethod
     def remove_empty_lines(file_name: str) -> str:
-        logger.info(f"{enchant.list_languages()}")
-        dictionary = enchant.Dict("ru_RU")
-        file_name_without_character = f'{file_name}_without_character.txt'
-        with open(file_name, "r", encoding="utf-8") as f:
-            with open(file_name_without_character, 'w') as f2:
-                data = f.read()
-                for line in data.split("\n"):
-                    with contextlib.suppress(Exception):
-                        if len(line.strip()) < 10 and not dictionary.check(line.strip().split()[1]):
-                            continue
-                        else:
-                            f2.write(line + "\n")
-        return file_name_without_character
+        return filter_file(file_name, f'{file_name}_without_character.txt')
 
     @staticmethod
-    def return_text_from_pdf(file_name_without_character: str) -> Response:
-        with open(file_name_without_character, 'r') as file:
-            data = file.read()
-        dict_new_file = {'text': data}
+    def read_text(file_name: str) -> str:
+        with open(file_name, 'r') as file:
+            return file.read()
+
+    def return_text_from_pdf(self, file_name_without_character: str) -> Response:
+        dict_new_file = {'text': self.read_text(file_name_without_character)}
         logger.info(f"type {type(dict_new_file)}")
         return jsonify(dict_new_file)
 
@@ -68,45 +62,50 @@ class PDF(object):
         logger.info(f"type {type(dict_new_file)}")
         return jsonify(dict_new_file)
 
-    def get_file_from_cache(self, path_root_completed_files: str) -> Tuple[bool, str]:
-        for root, dirs, files in os.walk(path_root_completed_files, topdown=False):
-                for name in files:
-                    if os.path.basename(self.absolute_path_filename).split(".pdf")[0] + ".txt" == name:
-                        return True, os.path.join(root, name)
-        return False, path_root_completed_files
+    @staticmethod
+    def get_cache_index(path_root_completed_files: str) -> CacheIndex:
+        return get_cache_index(f"{path_root_completed_files}/cache_index.sqlite3", OCR_CACHE_MAX_SIZE)
+
+    def get_file_from_cache(self, path_root_completed_files: str, content_hash: str) -> Tuple[bool, str]:
+        cached_file = self.get_cache_index(path_root_completed_files).get(content_hash)
+        if cached_file is None:
+            return False, path_root_completed_files
+        return True, cached_file
 
     @staticmethod
-    def truncate(path: str) -> None:
-        files = glob.glob(f'{path}/*.*')
-        for f in files:
+    def truncate(filenames: list) -> None:
+        for f in filenames:
             os.remove(f)
 
-    def get_files(self, file: str, directory: str, total_pages: int, path_root_completed_files: str) -> TextIO:
-        infinite_loop = True
-        filenames = []
-        while infinite_loop:
-            for root, dirs, files in os.walk(directory, topdown=False):
-                for name in files:
-                    if file in name:
-                        if os.path.join(root, name) not in filenames:
-                            filenames.append(os.path.join(root, name))
-                            filenames = sorted(filenames,
-                                               key=lambda x: int(re.findall(r'\d{1,5}', re.split("[.]pdf", x)[1])[0]))
-                        infinite_loop = len(filenames) != total_pages
+    def get_files(self, file: str, directory: str, total_pages: int, path_root_completed_files: str,
+                  content_hash: str) -> TextIO:
+        self.report_progress("ocr", 0.0)
+        filenames = get_page_collector(directory).wait_for_pages(
+            file, total_pages, on_page=lambda ready_pages: self.report_progress("ocr", ready_pages / total_pages)
+        )
         logger.info(f"All needed files {filenames}")
-        target_file = self.concatenate_files(f"{path_root_completed_files}/{file}.txt", filenames)
-        self.truncate(directory)
+        target_file = self.concatenate_files(f"{path_root_completed_files}/{content_hash}.txt", filenames)
+        self.get_cache_index(path_root_completed_files).put(content_hash, target_file.name)
+        self.truncate(filenames)
         return target_file
 
-    def main(self) -> Response:
+    def get_text(self) -> str:
         path_root = os.environ.get('PATH_ROOT')
         path_root_completed_files = os.environ.get('PATH_ROOT_COMPLETED_FILES')
-        pdf_file = pikepdf.Pdf.open(self.absolute_path_filename)
-        is_exist_file_in_cache, final_file = self.get_file_from_cache(path_root_completed_files)
+        content_hash = self.content_id or file_hash(self.absolute_path_filename)
+        is_exist_file_in_cache, final_file = self.get_file_from_cache(path_root_completed_files, content_hash)
         if is_exist_file_in_cache:
-            return self.return_text_from_pdf(final_file)
-        if not Path(f"{path_root}/{self.file.filename}").is_file():
+            return self.read_text(final_file)
+        moved_path = f"{path_root}/{self.file.filename}"
+        if not os.path.isfile(self.absolute_path_filename) and os.path.isfile(moved_path):
+            # Файл с тем же содержимым уже передан на OCR прошлой задачей, упавшей или потерянной при перезапуске
+            self.absolute_path_filename = moved_path
+        pdf_file = pikepdf.Pdf.open(self.absolute_path_filename)
+        if not Path(moved_path).is_file():
             shutil.move(self.absolute_path_filename, path_root)
         new_file = self.get_files(os.path.basename(self.absolute_path_filename).replace(".pdf", ""), f"{path_root}/txt",
-                                  pdf_file.Root.Pages.Count, path_root_completed_files)
-        return self.return_text_from_pdf(new_file.name)
+                                  pdf_file.Root.Pages.Count, path_root_completed_files, content_hash)
+        return self.read_text(new_file.name)
+
+    def main(self) -> Response:
+        return jsonify({'text': self.get_text()})
@@ -0,0 +1,71 @@
+import json
+import uuid
+import hashlib
+import threading
+import contextlib
+from __init__ import *
+from cache_index import CacheIndex, get_cache_index
+from typing import Iterable, Iterator, Optional
+
+REPORT_CACHE_DIR = os.environ.get("REPORT_CACHE_DIR", f"{os.environ.get('PATH_DOCUMENTS')}/reports")
+REPORT_CACHE_MAX_SIZE = int(os.environ.get("REPORT_CACHE_MAX_SIZE", 2 * 1024 ** 3))
+# Увеличивается при изменении вида протокола, чтобы не отдавать отчёты, собранные прежним кодом
+REPORT_FORMAT_VERSION = 1
+
+
+def report_key(*values) -> str:
+    """Хеш входных данных протокола, каждое значение хешируется вместе с длиной, чтобы их нельзя было склеить"""
+    sha256 = hashlib.sha256(f"report-v{REPORT_FORMAT_VERSION}".encode())
+    for value in values:
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        sha256.update(len(data).to_bytes(8, "big"))
+        sha256.update(data)
+    return sha256.hexdigest()
+
+
+class ReportCache(object):
+    """Готовые протоколы разногласий на диске по хешу входных данных, лишние удаляются CacheIndex"""
+
+    def __init__(self, directory: str = REPORT_CACHE_DIR, max_size: int = REPORT_CACHE_MAX_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self.index: CacheIndex = get_cache_index(f"{directory}/cache_index.sqlite3", max_size)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(directory={self.directory})'
+
+    def get(self, key: str) -> Optional[str]:
+        return self.index.get(key)
+
+    def write_through(self, key: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Отдаёт куски протокола дальше и пишет их во временный файл. В кэш файл попадает,
+        только если протокол отдан целиком, иначе временный файл удаляется
+        """
+        path = os.path.join(self.directory, f"{key}.docx")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        is_completed = False
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, path)
+            is_completed = True
+            self.index.put(key, path)
+        finally:
+            if not is_completed:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp_path)
+
+
+_report_cache: Optional[ReportCache] = None
+_report_cache_lock = threading.Lock()
+
+
+def get_report_cache() -> ReportCache:
+    global _report_cache
+    with _report_cache_lock:
+        if _report_cache is None:
+            _report_cache = ReportCache()
+        return _report_cache
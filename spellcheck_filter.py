@@ -0,0 +1,55 @@
+import enchant
+import threading
+import functools
+from __init__ import *
+from typing import Iterable, Iterator, Optional
+
+SPELLCHECK_LANGUAGE = os.environ.get("SPELLCHECK_LANGUAGE", "ru_RU")
+SPELLCHECK_CACHE_SIZE = int(os.environ.get("SPELLCHECK_CACHE_SIZE", 64 * 1024))
+# Строка короче этого остаётся, только если её второе слово есть в словаре
+SHORT_LINE_LENGTH = 10
+
+_dictionary: Optional[enchant.Dict] = None
+_dictionary_lock = threading.Lock()
+
+
+def get_dictionary() -> enchant.Dict:
+    """Словарь, загруженный один раз на процесс"""
+    global _dictionary
+    with _dictionary_lock:
+        if _dictionary is None:
+            logger.info(f"Spellcheck languages {enchant.list_languages()}, used {SPELLCHECK_LANGUAGE}")
+            _dictionary = enchant.Dict(SPELLCHECK_LANGUAGE)
+        return _dictionary
+
+
+@functools.lru_cache(maxsize=SPELLCHECK_CACHE_SIZE)
+def is_known_word(word: str) -> bool:
+    dictionary = get_dictionary()
+    with _dictionary_lock:
+        return dictionary.check(word)
+
+
+def is_kept_line(line: str) -> bool:
+    """
+    Длинные строки остаются всегда. Короткая строка остаётся, если в ней есть второе слово и оно из словаря,
+    иначе это пустая строка или обрывок распознавания
+    """
+    stripped = line.strip()
+    if len(stripped) >= SHORT_LINE_LENGTH:
+        return True
+    words = stripped.split()
+    return len(words) > 1 and is_known_word(words[1])
+
+
+def filter_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Оставляет строки по is_kept_line, строки читаются и отдаются по одной без изменений"""
+    return (line for line in lines if is_kept_line(line))
+
+
+def filter_file(file_name: str, target_file_name: str) -> str:
+    """Пишет в target_file_name строки file_name, прошедшие фильтр, каждую с переводом строки"""
+    with open(file_name, "r", encoding="utf-8") as f, open(target_file_name, "w", encoding="utf-8") as f2:
+        for line in filter_lines(f):
+            f2.write(line.rstrip("\n") + "\n")
+    return target_file_name
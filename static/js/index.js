@@ -10,53 +10,172 @@ function isObject (n) {
           return Object.prototype.toString.call(n) === '[object Object]';
         }
 
-Dropzone.options.initial = {
+function showUploadError() {
+    Swal.fire(
+        'Ошибка!',
+        'Вы загрузили не поддерживаемый подтип файла или файл поврежден!',
+        'error'
+    );
+}
+
+function showJobError() {
+    Swal.fire(
+        'Ошибка!',
+        'Не удалось получить результат обработки документа, загрузите его ещё раз',
+        'error'
+    );
+}
+
+// Запускает обработку собранного на сервере файла, null если сервер не ответил или не принял запрос
+async function completeUpload(file) {
+    try {
+        const fetchPromise = await fetch(`/upload/${file.upload.uuid}/complete`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({"filename": file.name})
+        });
+        if (!fetchPromise.ok) {
+            return null;
+        }
+        file.uploadResult = await fetchPromise.json();
+        return file.uploadResult;
+    } catch (error) {
+        return null;
+    }
+}
+
+const maxJobResubmits = 5;
+
+// Документ обрабатывается в фоне: опрашиваем задачу, пока она не завершится. Задачи хранятся в памяти сервера,
+// поэтому задача, потерянная при перезапуске или удалённая по истечении срока, запускается заново
+// по состоянию загрузки на диске
+async function waitForJob(file, textarea) {
+    let resubmits = 0;
+    while (true) {
+        let fetchPromise = null;
+        try {
+            fetchPromise = await fetch(`/jobs/${file.uploadResult["job_id"]}`);
+        } catch (error) {
+            console.log(error);
+        }
+        if (fetchPromise === null || !fetchPromise.ok) {
+            if (resubmits >= maxJobResubmits) {
+                $(textarea).val("");
+                showJobError();
+                return;
+            }
+            resubmits++;
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            await completeUpload(file);
+            continue;
+        }
+        const job = await fetchPromise.json();
+        if (job["status"] === "done") {
+            $(textarea).val(job["result"]);
+            return;
+        }
+        if (job["status"] === "error") {
+            showUploadError();
+            return;
+        }
+        const progress = job["progress"] === null ? "" : ` ${Math.round(job["progress"] * 100)}%`;
+        $(textarea).val(`Обработка документа: ${job["stage"]}${progress}`);
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
+// Один и тот же файл получает тот же id загрузки, чтобы после обрыва сервер продолжил с полученных кусков.
+// Размер куска входит в id: куски другого размера сервер для начатой загрузки не примет
+async function getUploadId(file, chunkSize) {
+    const key = new TextEncoder().encode(`${file.name}:${file.size}:${file.lastModified}:${chunkSize}`);
+    const digest = await crypto.subtle.digest("SHA-256", key);
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, "0")).join("").slice(0, 32);
+}
+
+// Куски, которые сервер уже получил при прошлой попытке загрузить этот файл
+async function getReceivedChunks(uploadId, totalChunks) {
+    try {
+        const fetchPromise = await fetch(`/upload/${uploadId}`);
+        if (!fetchPromise.ok) {
+            return new Set();
+        }
+        const status = await fetchPromise.json();
+        if (status["total_chunks"] !== totalChunks) {
+            return new Set();
+        }
+        return new Set(status["received"]);
+    } catch (error) {
+        return new Set();
+    }
+}
+
+// Куски уходят параллельно и в любом порядке, обработка запускается отдельным запросом после последнего куска
+const chunkedUploadOptions = {
     paramName: "file",
     chunking: true,
     forceChunking: true,
+    parallelChunkUploads: true,
+    retryChunks: true,
+    retryChunksLimit: 5,
     url: "/upload",
     maxFilesize: 1025, // megabytes
-    chunkSize: 250000, // bytes,
+    chunkSize: 250000, // bytes
+    accept: function(file, done) {
+        getUploadId(file, this.options.chunkSize).then(async uploadId => {
+            file.upload.uuid = uploadId;
+            file.receivedChunks = await getReceivedChunks(uploadId, Math.ceil(file.size / this.options.chunkSize));
+            done();
+        }, () => done());
+    },
+    // Dropzone не умеет пропускать куски: уже полученные сервером сразу отмечаются загруженными без отправки
+    init: function() {
+        const uploadData = this._uploadData.bind(this);
+        this._uploadData = function(files, dataBlocks) {
+            const file = files[0];
+            const chunk = file.upload.chunked ? file.upload.chunks[dataBlocks[0].chunkIndex] : undefined;
+            if (chunk !== undefined && file.receivedChunks !== undefined && file.receivedChunks.has(chunk.index)) {
+                chunk.progress = 100;
+                chunk.total = chunk.bytesSent = dataBlocks[0].data.size;
+                file.upload.finishedChunkUpload(chunk, null);
+                return;
+            }
+            uploadData(files, dataBlocks);
+        };
+    },
+    // Dropzone ждёт done и при ошибке, иначе файл так и останется загружающимся
+    chunksUploaded: async function(file, done) {
+        if (await completeUpload(file) === null) {
+            file.uploadResult = null;
+            showUploadError();
+        }
+        done();
+    },
+    error: function(file, response) {
+        showUploadError();
+    }
+}
+
+Dropzone.options.initial = {
+    ...chunkedUploadOptions,
     dictDefaultMessage: "Поместите сюда исходный файл с расширениями (doc, docx, pdf)",
     success: function(file, response){
-        if (isObject(response)) {
-            $("textarea#docx").val(response["text"]);
-        } else {
-            $("textarea#docx").val(response);
+        if (!file.uploadResult) {
+            return;
         }
+        waitForJob(file, "textarea#docx");
         document.getElementsByClassName("dz-filename")[0].getElementsByTagName('span')[0].innerHTML = "Исходный файл"
-    },
-    error: function(file, response) {
-        Swal.fire(
-            'Ошибка!',
-            'Вы загрузили не поддерживаемый подтип файла или файл поврежден!',
-            'error'
-        );
     }
 }
 
 Dropzone.options.edited = {
-    paramName: "file",
-    chunking: true,
-    forceChunking: true,
-    url: "/upload",
-    maxFilesize: 1025, // megabytes
-    chunkSize: 250000, // bytes
+    ...chunkedUploadOptions,
     dictDefaultMessage: "Поместите сюда отредактированный файл с расширениями (doc, docx, pdf)",
     success: function(file, response){
-        if (isObject(response)) {
-            $("textarea#pdf").val(response["text"]);
-        } else {
-            $("textarea#pdf").val(response);
+        if (!file.uploadResult) {
+            return;
         }
+        waitForJob(file, "textarea#pdf");
         document.getElementsByClassName("dz-filename")[1].getElementsByTagName('span')[0].innerHTML = "Отредактированный файл"
-    },
-    error: function(file, response) {
-        Swal.fire(
-            'Ошибка!',
-            'Вы загрузили не поддерживаемый подтип файла или файл поврежден!',
-            'error'
-        );
     }
 }
 
@@ -64,27 +183,74 @@ document.getElementById("unified").onclick= async ()=> {
     var threshold = parseInt(document.getElementById('threshold').value);
     var docx = document.getElementById('docx').value;
     var pdf = document.getElementById('pdf').value;
-    const dictFile = {"docx": docx, "pdf": pdf, "threshold": threshold};
+    const dictFile = {"docx": docx, "pdf": pdf, "threshold": threshold, "stream": true};
     document.getElementById("loader").style.display = "block";
     const allButton = document.querySelectorAll('button');
     allButton.forEach(button => {
         button.disabled = true;
     });
-    let fetchPromise = await fetch("/unified/", {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(dictFile),
-            mode: 'cors'
+    // Главы приходят построчно в NDJSON: поля заменяются, только когда пришли первые главы успешного ответа,
+    // и дополняются по мере выравнивания. Загрузчик и кнопки возвращаются в любом случае
+    let isError = false;
+    try {
+        const fetchPromise = await fetch("/unified/", {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(dictFile),
+                mode: 'cors'
+            });
+        if (!fetchPromise.ok) {
+            isError = true;
+            return;
+        }
+        const docxChapters = [];
+        const pdfChapters = [];
+        const addChapter = (line) => {
+            if (!line) {
+                return;
+            }
+            const chapter = JSON.parse(line);
+            if (chapter['error'] !== undefined) {
+                isError = true;
+                return;
+            }
+            docxChapters.push(chapter['docx']);
+            pdfChapters.push(chapter['pdf']);
+        };
+        const showChapters = () => {
+            $("textarea#docx").val(docxChapters.join(""));
+            $("textarea#pdf").val(pdfChapters.join(""));
+        };
+        const reader = fetchPromise.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) {
+                break;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split("\n");
+            buffer = lines.pop();
+            if (lines.some(line => line)) {
+                lines.forEach(addChapter);
+                showChapters();
+            }
+        }
+        addChapter(buffer + decoder.decode());
+        showChapters();
+    } catch (error) {
+        console.log(error);
+        isError = true;
+    } finally {
+        document.getElementById("loader").style.display = "none";
+        allButton.forEach(button => {
+            button.disabled = false;
         });
-    document.getElementById("loader").style.display = "none";
-    allButton.forEach(button => {
-        button.disabled = false;
-    });
-    console.log(fetchPromise);
-    const response = await fetchPromise.json();
-    console.log(response);
-    $("textarea#docx").val(response['docx']);
-    $("textarea#pdf").val(response['pdf']);
+        if (isError) {
+            Swal.fire('Ошибка!', 'Не удалось выровнять документы!', 'error');
+        }
+    }
 };
 
 document.getElementById("downloadReport").onclick= async ()=> {
@@ -0,0 +1,51 @@
+import itertools as itt
+import cache_index
+from cache_index import CacheIndex
+
+
+def put_file(index: CacheIndex, directory, key: str, size: int) -> str:
+    path = directory / f'{key}.txt'
+    path.write_bytes(b'x' * size)
+    index.put(key, str(path))
+    return str(path)
+
+
+def test_least_recently_used_entries_are_evicted_first(tmp_path, monkeypatch):
+    clock = itt.count(1)
+    monkeypatch.setattr(cache_index.time, 'time', lambda: next(clock))
+    index = CacheIndex(str(tmp_path / 'cache_index.sqlite3'), max_size=300)
+    paths = {key: put_file(index, tmp_path, key, 100) for key in ('a', 'b', 'c')}
+
+    # a is touched, so b becomes the least recently used entry
+    assert index.get('a') == paths['a']
+    paths['d'] = put_file(index, tmp_path, 'd', 100)
+
+    assert index.get('b') is None
+    assert not (tmp_path / 'b.txt').exists()
+    assert index.get('a') == paths['a']
+    assert index.get('c') == paths['c']
+    assert index.get('d') == paths['d']
+
+    # the checks above touched a, c and d in this order, so a bigger entry evicts a and then c
+    paths['e'] = put_file(index, tmp_path, 'e', 150)
+    assert index.get('a') is None
+    assert index.get('c') is None
+    assert index.get('d') == paths['d']
+    assert index.get('e') == paths['e']
+
+    # the entry being put is never evicted, even if it is bigger than the whole cache
+    paths['f'] = put_file(index, tmp_path, 'f', 400)
+    assert index.get('d') is None
+    assert index.get('e') is None
+    assert index.get('f') == paths['f']
+
+
+def test_entry_with_removed_file_is_dropped(tmp_path):
+    index = CacheIndex(str(tmp_path / 'cache_index.sqlite3'), max_size=1000)
+    path = put_file(index, tmp_path, 'a', 10)
+
+    (tmp_path / 'a.txt').unlink()
+
+    assert index.get('a') is None
+    put_file(index, tmp_path, 'a', 10)
+    assert index.get('a') == path
@@ -0,0 +1,42 @@
+import os
+import random
+from docx_ import Docx
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_lines(file_name: str) -> list:
+    with open(os.path.join(TESTS_DIR, file_name), 'r') as f:
+        return f.readlines()
+
+
+def test_format_paragraphs_keeps_last_paragraph(tmp_path):
+    docx = Docx(str(tmp_path / 'document.docx'))
+    docx_text = read_lines('list_docx_text_4.txt')
+    pdf_text = read_lines('list_pdf_text_4.txt')
+
+    result = docx.format_paragraphs(docx_text, pdf_text)
+
+    assert result.endswith(Docx.join_paragraph_lines(Docx.clean_special_chars(pdf_text[-3:])))
+    assert result.count('\n') == len(docx.get_paragraph_starts(Docx.clean_special_chars(docx_text),
+                                                                 Docx.clean_special_chars(pdf_text)))
+
+
+def get_contract_lines(count: int) -> list:
+    words = ['сторона', 'договор', 'оплата', 'поставка', 'груз', 'порт', 'срок', 'акт', 'счёт', 'заявка',
+             'перевозчик', 'клиент', 'контейнер', 'хранение', 'услуга', 'претензия', 'штраф', 'приложение']
+    rnd = random.Random(14)
+    return [f"{' '.join(rnd.choice(words) for _ in range(8))}\n" for _ in range(count)]
+
+
+def test_unmatched_docx_line_does_not_move_paragraph_starts(tmp_path):
+    docx = Docx(str(tmp_path / 'document.docx'))
+    pdf_text = get_contract_lines(400)
+    pdf_text[390] = 'Генеральный директор подписывает договор поставки\n'
+    docx_text = list(pdf_text)
+    # the line is missing in pdf near its place, but is similar to a pdf line at the end of the document
+    docx_text.insert(200, 'Генеральный директор подписывает договор\n')
+    # and this one is similar to nothing
+    docx_text.insert(100, 'Приложение № 5 к настоящему документу\n')
+
+    assert docx.get_paragraph_starts(docx_text, pdf_text) == set(range(400))
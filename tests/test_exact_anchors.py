@@ -0,0 +1,56 @@
+import itertools as itt
+import random
+from unified.exact_anchors import find_exact_anchors, get_longest_increasing_chain
+from unified.paragraph import ChapterSide, paragraph_factory
+
+
+def is_increasing_chain(chain):
+    return all(a[0] < b[0] and a[1] < b[1] for a, b in itt.pairwise(chain))
+
+
+def get_longest_chain_length(pairs):
+    for length in range(len(pairs), 0, -1):
+        if any(is_increasing_chain(sorted(chain)) for chain in itt.combinations(pairs, length)):
+            return length
+    return 0
+
+
+def test_longest_increasing_chain_is_the_same_as_brute_force():
+    rnd = random.Random(15)
+    for _ in range(2000):
+        # small ranges give ties on both sides and repeated pairs
+        pairs = sorted((rnd.randint(0, 6), rnd.randint(0, 6)) for _ in range(rnd.randint(0, 8)))
+
+        chain = get_longest_increasing_chain(pairs)
+
+        assert is_increasing_chain(chain)
+        assert all(pair in pairs for pair in chain)
+        assert len(chain) == get_longest_chain_length(pairs)
+
+
+def test_longest_increasing_chain_with_ties():
+    assert get_longest_increasing_chain([]) == []
+    assert get_longest_increasing_chain([(1, 1), (1, 2), (1, 3)]) in ([(1, 1)], [(1, 2)], [(1, 3)])
+    assert get_longest_increasing_chain([(1, 2), (2, 2), (3, 2)]) in ([(1, 2)], [(2, 2)], [(3, 2)])
+    assert get_longest_increasing_chain([(1, 5), (2, 1), (2, 6), (3, 2), (4, 3)]) == [(2, 1), (3, 2), (4, 3)]
+
+
+def get_chapter_side(lines):
+    paragraphs = paragraph_factory(lines)
+    positions = list(paragraphs)
+    return ChapterSide(paragraphs, positions[0], positions[-1]), positions
+
+
+def test_find_exact_anchors_ignores_duplicated_lines():
+    first = 'первый пункт договора о перевозке грузов морским транспортом\n'
+    second = 'второй пункт договора о порядке расчётов между сторонами\n'
+    third = 'третий пункт договора об ответственности сторон за нарушение\n'
+    repeated = 'настоящий пункт повторяется в тексте договора несколько раз\n'
+    short = 'короткая строка\n'
+    left, left_positions = get_chapter_side([first, repeated, second, short, repeated, third])
+    right, right_positions = get_chapter_side([repeated, first, second, short, third, second])
+
+    anchors = find_exact_anchors(left, right)
+
+    # repeated is not unique on the left, second is not unique on the right, short is too short to be an anchor
+    assert anchors == [(left_positions[0], right_positions[1]), (left_positions[5], right_positions[4])]
@@ -0,0 +1,34 @@
+import random
+from unified.paragraph import Paragraph
+
+ALPHABET = ['a', 'b', 'cd', ' ', ' ', '\t', '\xa0', 'efgh', '\n', 'ж']
+
+
+def rebuild(symbols):
+    paragraph = Paragraph(symbols, 0, (None, None))
+    return paragraph.symbols, list(paragraph.token_borders)
+
+
+def test_split_is_the_same_as_cleaning_pieces_again():
+    rnd = random.Random(5)
+    for _ in range(20000):
+        paragraph = Paragraph(''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 40))), 0, (None, None))
+        cut = rnd.randint(2, len(paragraph.symbols) + 2)
+
+        parent_symbols, parent_token_borders, child_symbols, child_token_borders = paragraph.split(cut)
+
+        assert (parent_symbols, list(parent_token_borders)) == rebuild(paragraph.symbols[:cut] + '\n')
+        assert (child_symbols, list(child_token_borders)) == rebuild(paragraph.symbols[cut:])
+
+
+def test_split_pieces_tokens():
+    paragraph = Paragraph('first second third  fourth fifth', 0, (None, None))
+
+    parent_symbols, parent_token_borders, child_symbols, child_token_borders = paragraph.split(13)
+
+    parent = Paragraph(parent_symbols, 0, (None, None), token_borders=parent_token_borders)
+    child = Paragraph(child_symbols, 13, (parent, None), token_borders=child_token_borders)
+    assert parent.symbols == 'first second\n'
+    assert list(parent.tokens) == ['first second\n']
+    assert child.symbols == 'third fourth fifth\n'
+    assert list(child.tokens) == ['third fourth', ' fourth fifth\n']
@@ -0,0 +1,70 @@
+import bisect
+import os
+
+from rapidfuzz.utils import default_process
+
+from unified.paragraph import ParagraphStore
+
+# Paragraphs are anchored by the first ANCHOR_WORDS_COUNT normalized words, keys shorter than
+# ANCHOR_MIN_SYMBOLS are too common to be anchors. 0 words turns the pre-alignment off
+ANCHOR_WORDS_COUNT = int(os.environ.get("ANCHOR_WORDS_COUNT", 6))
+ANCHOR_MIN_SYMBOLS = int(os.environ.get("ANCHOR_MIN_SYMBOLS", 24))
+
+
+def get_anchor_key(symbols: str):
+    """First ANCHOR_WORDS_COUNT words of the paragraph in lower case without punctuation, None if it is too short"""
+    words = default_process(symbols).split()
+    if len(words) < ANCHOR_WORDS_COUNT:
+        return None
+    key = ' '.join(words[:ANCHOR_WORDS_COUNT])
+    return key if len(key) >= ANCHOR_MIN_SYMBOLS else None
+
+
+def get_unique_anchor_keys(paragraphs: ParagraphStore, start_id: int, end_id: int):
+    """Anchor keys met only once in paragraphs from start_id to end_id, with positions of their paragraphs"""
+    positions = dict()
+    for pos in paragraphs.irange(start_id, end_id):
+        key = get_anchor_key(paragraphs[pos].symbols)
+        if key is not None:
+            positions[key] = None if key in positions else pos
+    return {key: pos for key, pos in positions.items() if pos is not None}
+
+
+def get_longest_increasing_chain(pairs: list):
+    """
+    Longest chain of (left, right) pairs strictly increasing on both sides.
+    Patience sorting: piles keep the smallest right ending a chain of every length. Pairs with the same left
+    go in decreasing order of right, so no two of them get into one chain
+    """
+    pairs = sorted(pairs, key=lambda pair: (pair[0], -pair[1]))
+    pile_tops = []
+    pile_top_ids = []
+    prev_ids = []
+    for i, (_, right) in enumerate(pairs):
+        pile = bisect.bisect_left(pile_tops, right)
+        prev_ids.append(pile_top_ids[pile - 1] if pile else None)
+        if pile == len(pile_tops):
+            pile_tops.append(right)
+            pile_top_ids.append(i)
+        else:
+            pile_tops[pile] = right
+            pile_top_ids[pile] = i
+    chain = []
+    i = pile_top_ids[-1] if pile_top_ids else None
+    while i is not None:
+        chain.append(pairs[i])
+        i = prev_ids[i]
+    return chain[::-1]
+
+
+def find_exact_anchors(left_chapter, right_chapter):
+    """
+    Pairs of left and right paragraph positions starting with the same normalized words that are unique on both
+    sides, the longest chain of them in the same order on both sides, as in patience diff
+    """
+    if ANCHOR_WORDS_COUNT <= 0:
+        return []
+    left_keys = get_unique_anchor_keys(left_chapter.paragraphs, left_chapter.start_id, left_chapter.end_id)
+    right_keys = get_unique_anchor_keys(right_chapter.paragraphs, right_chapter.start_id, right_chapter.end_id)
+    pairs = sorted((left_pos, right_keys[key]) for key, left_pos in left_keys.items() if key in right_keys)
+    return get_longest_increasing_chain(pairs)
@@ -1,30 +1,54 @@
 import itertools as itt
+import bisect
+from array import array
+from collections.abc import MutableMapping, Sequence
 import datetime as dt
 import logging
+import multiprocessing
 from logging.handlers import RotatingFileHandler
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import heapq
 import re
 import numpy as np
 import os
 
 
-import fuzzywuzzy.fuzz
-from fuzzywuzzy import process
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+
+from unified.trigram_index import TrigramIndex
+from unified.score_cache import get_score_cache
 
 
 logger = logging.getLogger(__name__)
 
+# Threads used by rapidfuzz for batched token scoring, -1 means all cores
+CDIST_WORKERS = int(os.environ.get("CDIST_WORKERS", -1))
+# Right tokens scored below the cutoff are dropped inside rapidfuzz. Default is 0 because BestBorder* matchers
+# pair the best token with any candidate on the other side of the border, so a cutoff changes found borders
+BORDER_TOKEN_SCORE_CUTOFF = float(os.environ.get("BORDER_TOKEN_SCORE_CUTOFF", 0))
+BORDER_TOKEN_LIMIT = 3
+# Right sides with at least this many tokens are searched through a trigram index:
+# every left token is scored only against TRIGRAM_CANDIDATES right tokens sharing the most trigrams with it
+TRIGRAM_INDEX_MIN_TOKENS = int(os.environ.get("TRIGRAM_INDEX_MIN_TOKENS", 2000))
+TRIGRAM_CANDIDATES = int(os.environ.get("TRIGRAM_CANDIDATES", 64))
+TOKEN_WORDS_COUNT = 2
+
 
 def init_my_logging():
     """
     Configuring logging for a SON-like appearance when running locally
     """
     logger.setLevel(logging.DEBUG)
-    log_file_name = os.path.splitext(os.path.realpath(__file__))[0] + '.log'
-    handler = RotatingFileHandler(log_file_name, maxBytes=1.5 * pow(1024, 2), backupCount=3)
     log_format = "%(asctime)-15s [{}:%(name)s:%(lineno)s:%(funcName)s:%(levelname)s] %(message)s".format(os.getpid())
-    handler.setLevel(logging.DEBUG)
+    if multiprocessing.parent_process() is not None:
+        # pool workers log to stderr, only the server process writes and rotates the log file
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.INFO)
+    else:
+        log_file_name = os.path.splitext(os.path.realpath(__file__))[0] + '.log'
+        handler = RotatingFileHandler(log_file_name, maxBytes=1.5 * pow(1024, 2), backupCount=3)
+        handler.setLevel(logging.DEBUG)
     try:
         from colorlog import ColoredFormatter
         formatter = ColoredFormatter(log_format)
@@ -39,14 +63,49 @@ def init_my_logging():
 init_my_logging()
 
 
+class ParagraphTokens(Sequence):
+    """Tokens of TOKEN_WORDS_COUNT words of a paragraph, cut from its symbols on access"""
+    __slots__ = ('symbols', 'token_borders')
+
+    def __init__(self, symbols, token_borders):
+        self.symbols = symbols
+        self.token_borders = token_borders
+
+    def __len__(self):
+        return max(len(self.token_borders) - TOKEN_WORDS_COUNT, 1)
+
+    def get_start_end(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('token index out of range')
+        if len(self.token_borders) <= TOKEN_WORDS_COUNT:
+            # paragraph with too few words is one token
+            return self.token_borders[0], self.token_borders[-1]
+        return self.token_borders[i], self.token_borders[i + TOKEN_WORDS_COUNT]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start, end = self.get_start_end(i)
+        return self.symbols[start:end]
+
+
 class Paragraph(object):
-    def __init__(self, symbols, position, nbrs, match_paragraph=None):
-        self.symbols = self._clean_symbols(symbols)
-        self.symbols_count = len(self.symbols)
+    __slots__ = ('symbols', 'global_position', 'symbols_position', 'token_borders', 'prev', 'next',
+                 'match_paragraph')
+
+    def __init__(self, symbols, position, nbrs, match_paragraph=None, symbols_position=None, token_borders=None):
+        """token_borders are passed only with symbols that are clean already, e.g. pieces of a split paragraph"""
+        if token_borders is None:
+            self.symbols = self._clean_symbols(symbols)
+            self.token_borders = self._get_cleaned_token_borders()
+        else:
+            self.symbols = symbols
+            self.token_borders = token_borders
         self.global_position = position
-        self.token_borders = self._get_cleaned_token_borders()
-        self.tokens, self.token_start_end = self._get_tokens(2)
-        self.tokens_count = len(self.tokens)
+        # a paragraph split from another one may start its symbols after its global position
+        self.symbols_position = position if symbols_position is None else symbols_position
         self.prev = nbrs[0]
         self.next = nbrs[1]
         self.match_paragraph = match_paragraph
@@ -56,6 +115,33 @@ class Paragraph(object):
         symbols_z = self.symbols[min(len(self.symbols), 15):]
         return f'{self.__class__.__name__}(global_position={self.global_position}, symbols=({symbols_a}...{symbols_z}))'
 
+    def __getstate__(self):
+        """Neighbours are not pickled, a chain of paragraphs is linked again after unpickling"""
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['prev'] = state['next'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def symbols_count(self):
+        return len(self.symbols)
+
+    @property
+    def tokens(self):
+        return ParagraphTokens(self.symbols, self.token_borders)
+
+    @property
+    def tokens_count(self):
+        return len(self.tokens)
+
+    @property
+    def token_start_end(self):
+        tokens = self.tokens
+        return [tokens.get_start_end(i) for i in range(len(tokens))]
+
     def _clean_symbols(self, symbols):
         new_symbols = re.sub(r"\s{2,}", " ", symbols)
         new_symbols += " "
@@ -63,7 +149,7 @@ class Paragraph(object):
         return new_symbols
 
     def _get_cleaned_token_borders(self):
-        token_borders = list(self._get_token_borders())
+        token_borders = array('i', self._get_token_borders())
         # token_borders2 = list(self._clean_token_borders(token_borders))
         return token_borders
 
@@ -84,19 +170,39 @@ class Paragraph(object):
                 yield a
         yield b
 
-    def _get_tokens(self, words_count):
-        tokens = []
-        tokens_start_end = []
-        for i in range(len(self.token_borders)-words_count):
-            start = self.token_borders[i]
-            end = self.token_borders[i+words_count]
-            token = self.symbols[start:end]
-            tokens.append(token)
-            tokens_start_end.append((start, end))
-        if not tokens:
-            tokens.append(self.symbols)
-            tokens_start_end.append((self.token_borders[0], self.token_borders[-1]))
-        return tokens, tokens_start_end
+    def split(self, cut):
+        """
+        Symbols and token borders of the pieces before and after cut, the same as cleaning the pieces and scanning them
+        for token borders again. Clean symbols have no adjacent whitespaces, so only the end of the first piece changes
+        and its token borders are the borders before the cut. Borders of the second piece are scanned only until they
+        meet the borders of this paragraph, the rest of them are shifted
+        """
+        token_borders = self.token_borders
+        last_border_i = len(token_borders) - 1
+
+        parent_symbols = self.symbols[:cut]
+        if parent_symbols[-1:].isspace():
+            parent_symbols = parent_symbols[:-1]
+        parent_symbols += '\n'
+        parent_token_borders = array('i', [0])
+        parent_token_borders.extend(token_borders[1:bisect.bisect_left(token_borders, len(parent_symbols) - 1,
+                                                                       1, last_border_i)])
+        parent_token_borders.append(len(parent_symbols))
+
+        child_symbols = self.symbols[cut:] or '\n'
+        child_token_borders = array('i', [0])
+        border = 0
+        while True:
+            border = child_symbols.find(' ', border + 4)
+            if border == -1:
+                child_token_borders.append(len(child_symbols))
+                break
+            i = bisect.bisect_left(token_borders, border + cut, 1, last_border_i)
+            if i < last_border_i and token_borders[i] == border + cut:
+                child_token_borders.extend(b - cut for b in token_borders[i:])
+                break
+            child_token_borders.append(border)
+        return parent_symbols, parent_token_borders, child_symbols, child_token_borders
 
     def get_token_pos_in_text(self, token):
         start = self.symbols._find_right_tokens(token)
@@ -106,8 +212,61 @@ class Paragraph(object):
 
 
 
+class ParagraphStore(MutableMapping):
+    """Paragraphs by global position with positions kept in a sorted array for O(log P) neighbour lookups"""
+
+    def __init__(self, paragraphs=()):
+        self._paragraphs = dict(paragraphs)
+        self._positions = sorted(self._paragraphs)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(count={len(self._positions)})'
+
+    def __getitem__(self, pos):
+        return self._paragraphs[pos]
+
+    def __setitem__(self, pos, paragraph):
+        if pos not in self._paragraphs:
+            bisect.insort(self._positions, pos)
+        self._paragraphs[pos] = paragraph
+
+    def __delitem__(self, pos):
+        del self._paragraphs[pos]
+        del self._positions[bisect.bisect_left(self._positions, pos)]
+
+    def __contains__(self, pos):
+        return pos in self._paragraphs
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __reversed__(self):
+        return reversed(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def get_position_before(self, pos):
+        i = bisect.bisect_left(self._positions, pos)
+        if not i:
+            raise ValueError(f'No paragraph before position {pos}')
+        return self._positions[i - 1]
+
+    def get_position_after(self, pos):
+        i = bisect.bisect_right(self._positions, pos)
+        if i == len(self._positions):
+            raise ValueError(f'No paragraph after position {pos}')
+        return self._positions[i]
+
+    def irange(self, start_id, end_id):
+        """Positions from start_id to end_id inclusive"""
+        start = bisect.bisect_left(self._positions, start_id)
+        end = bisect.bisect_right(self._positions, end_id)
+        return itt.islice(self._positions, start, end)
+
+
 def paragraph_factory(text):
-    """Creates dict[Paragraph] with absolute start position of every paragraph as dict key"""
+    """Creates ParagraphStore with absolute start position of every paragraph as key"""
     prev_p = None
     global_position = 0
     paragraphs = dict()
@@ -119,24 +278,46 @@ def paragraph_factory(text):
         if prev_p:
             prev_p.next = current_p
         prev_p = current_p
-    return paragraphs
+    return ParagraphStore(paragraphs)
+
+
+def get_paragraphs_chain(paragraphs: ParagraphStore, start_id: int, end_id: int):
+    """Linked paragraphs from start_id to end_id, with the empty ones that share a position with the next paragraph"""
+    chain = []
+    paragraph = paragraphs[start_id]
+    while paragraph and paragraph.global_position <= end_id:
+        chain.append(paragraph)
+        paragraph = paragraph.next
+    return chain
+
+
+def link_paragraphs_chain(chain: list, prev_p: Paragraph = None, next_p: Paragraph = None):
+    """Link paragraphs of the chain with each other, prev_p before the chain and next_p after it"""
+    for current_p, following_p in zip([prev_p] + chain, chain + [next_p]):
+        if current_p:
+            current_p.next = following_p
+        if following_p:
+            following_p.prev = current_p
+
+
+def replace_paragraphs_chain(paragraphs: ParagraphStore, old_chain: list, new_chain: list):
+    """Put new_chain in place of old_chain in the linked list and in the store, positions of old_chain are kept"""
+    link_paragraphs_chain(new_chain, old_chain[0].prev, old_chain[-1].next)
+    paragraphs.update((p.global_position, p) for p in new_chain)
 
 
 class ParagraphHandler(object):
-    def __init__(self, paragraphs= Paragraph):
+    def __init__(self, paragraphs: ParagraphStore):
         self.paragraphs = paragraphs
 
     def is_paragragrapth_with_position_exists(self, pos):
-        result = pos in self.paragraphs.keys()
-        return result
+        return pos in self.paragraphs
 
     def get_position_before(self, pos):
-        position_before = max((p for p in self.paragraphs.keys() if p < pos))
-        return position_before
+        return self.paragraphs.get_position_before(pos)
 
     def get_position_after(self, pos):
-        position_after = min((p for p in self.paragraphs.keys() if p > pos))
-        return position_after
+        return self.paragraphs.get_position_after(pos)
 
     def __repr__(self):
         return f'{self.__class__.__name__}'
@@ -152,27 +333,31 @@ class ParagraphHandler(object):
         logger.debug(f'pos_before={pos_before}, current_p={current_p}')
 
         slice = pos_spawn-pos_before+1
-        parent_symbols = current_p.symbols[:slice] + '\n'
+        parent_symbols, parent_token_borders, child_symbols, child_token_borders = current_p.split(slice)
         parent = Paragraph(symbols=parent_symbols, position=current_p.global_position,
-                           nbrs=(current_p.prev, None))
+                           nbrs=(current_p.prev, None), symbols_position=current_p.symbols_position,
+                           token_borders=parent_token_borders)
         logger.debug(f'parent is {parent}')
 
-        child_symbols = self.paragraphs[pos_before].symbols[slice:]
         child = Paragraph(symbols=child_symbols, position=pos_spawn,
-                          nbrs=(parent, current_p.next))
+                          nbrs=(parent, current_p.next), symbols_position=current_p.symbols_position + slice,
+                          token_borders=child_token_borders)
         logger.debug(f'child is {child}')
         parent.next = child
+        if current_p.prev:
+            current_p.prev.next = parent
+        if current_p.next:
+            current_p.next.prev = child
 
-        self.paragraphs.pop(pos_before)
         self.paragraphs[pos_before] = parent
         self.paragraphs[pos_spawn] = child
-        self.paragraphs = dict(sorted(self.paragraphs.items()))
         return parent, child
 
+
 class ChapterSide(object):
     """One side of chapter"""
 
-    def __init__(self, paragraphs: dict, start_id: int, end_id: int):
+    def __init__(self, paragraphs: ParagraphStore, start_id: int, end_id: int):
         self.paragraphs = paragraphs
         self.start_id = start_id
         self.end_id = end_id
@@ -180,16 +365,21 @@ class ChapterSide(object):
     def __repr__(self):
         return f'{self.__class__.__name__}(start_id={self.start_id}, end_id={self.end_id})'
 
+    def __getstate__(self):
+        """Paragraphs of the whole text are not pickled, the side gets paragraphs of its range after unpickling"""
+        state = self.__dict__.copy()
+        state['paragraphs'] = None
+        return state
+
     def spawn_child(self, spawn_global_position: int, spawn_local_position: int = 0):
         logger.debug(f'{self} will spawn child...')
         spawn_sum_position = spawn_global_position + spawn_local_position
         logger.debug(f'spawn_global_position={spawn_global_position}, spawn_local_position={spawn_local_position} '
                      f'spawn_sum_position={spawn_sum_position}')
-        paragraph_handler = ParagraphHandler(self.paragraphs)
-        if not paragraph_handler.is_paragragrapth_with_position_exists(spawn_sum_position):
-            paragraph_handler.spawn_child(spawn_sum_position)
+        if spawn_sum_position not in self.paragraphs:
+            ParagraphHandler(self.paragraphs).spawn_child(spawn_sum_position)
         parent = ChapterSide(paragraphs=self.paragraphs, start_id=self.start_id,
-                             end_id=paragraph_handler.get_position_before(spawn_sum_position))
+                             end_id=self.paragraphs.get_position_before(spawn_sum_position))
 
         # end_id = paragraph_handler.get_position_after(spawn_global_position)
         # end_id = paragraph_handler.get_position_before(end_id)
@@ -197,21 +387,43 @@ class ChapterSide(object):
 
         return parent, child
 
+    def get_text(self):
+        return ''.join(self.paragraphs[pos].symbols for pos in self.paragraphs.irange(self.start_id, self.end_id))
+
 @dataclass
 class FoundRightToken:
     text: str
     rate: int
     paragraph_id: int
     relative_pos: float
+    score: float = None
+
+
+def get_top_indices(scores, limit):
+    """Indices of the `limit` best scores, ties are resolved by the lowest index"""
+    if len(scores) > limit:
+        kth_score = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        indices = np.flatnonzero(scores >= kth_score)
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.argsort(-scores[indices], kind="stable")][:limit]
 
 
 class BorderTokenMatch(object):
-    def __init__(self, left_token: str, right_tokens: dict):
+    def __init__(self, left_token: str, right_tokens: dict, found_right_tokens: list = None):
         self.left_token = left_token
         self.right_tokens = right_tokens
-        self.right_tokens_min_id = min(self.right_tokens.keys())
-        self.right_tokens_max_id = max(self.right_tokens.keys())
-        self.found_right_tokens = list(self._find_right_tokens())
+        if found_right_tokens is None:
+            found_right_tokens = self.find_right_tokens([left_token], right_tokens)[0]
+        self.found_right_tokens = found_right_tokens
+
+    @property
+    def right_tokens_min_id(self):
+        return min(self.right_tokens.keys())
+
+    @property
+    def right_tokens_max_id(self):
+        return max(self.right_tokens.keys())
 
     def __repr__(self):
         return str(dict(
@@ -222,22 +434,65 @@ class BorderTokenMatch(object):
             found_right_tokens=self.found_right_tokens
         ))
 
-    def _find_right_tokens(self):
-        found_right_tokens_and_rates = process.extract(query=self.left_token,
-                                                       choices=self.right_tokens.values(),
-                                                       scorer=fuzzywuzzy.fuzz.ratio,
-                                                       limit=3)
-        for found_right_token, found_right_token_rate in found_right_tokens_and_rates:
-            paragraph_id = next((k for k, v in self.right_tokens.items() if v == found_right_token), (None, None))
-            yield FoundRightToken(text=found_right_token,
-                                  rate=found_right_token_rate,
-                                  paragraph_id=paragraph_id,
-                                  relative_pos=paragraph_id/self.right_tokens_max_id)
+    @staticmethod
+    def _cdist(left_texts: list, right_texts: list, workers: int = CDIST_WORKERS):
+        def score(left, right):
+            return process.cdist(left, right, scorer=fuzz.ratio, score_cutoff=BORDER_TOKEN_SCORE_CUTOFF,
+                                 workers=workers)
+        score_cache = get_score_cache()
+        if score_cache is None:
+            return score(left_texts, right_texts)
+        return score_cache.get_scores(left_texts, right_texts, score)
+
+    @classmethod
+    def _score_right_tokens(cls, left_texts: list, right_texts: list):
+        """
+        Yield (right token indices, scores) for every left text. Indices are None when all right tokens were scored.
+        Long right sides are pruned with a trigram index, with a full scan if it finds too few candidates
+        """
+        if len(right_texts) < TRIGRAM_INDEX_MIN_TOKENS:
+            for row_scores in cls._cdist(left_texts, right_texts):
+                yield None, row_scores
+            return
+        trigram_index = TrigramIndex(right_texts)
+        for left_text in left_texts:
+            candidates = trigram_index.get_candidates(left_text, TRIGRAM_CANDIDATES)
+            if len(candidates) < BORDER_TOKEN_LIMIT:
+                yield None, cls._cdist([left_text], right_texts)[0]
+            else:
+                yield candidates, cls._cdist([left_text], [right_texts[i] for i in candidates], workers=1)[0]
+
+    @classmethod
+    def find_right_tokens(cls, left_tokens: list, right_tokens: dict, right_tokens_max_id: int = None):
+        """
+        Score all left tokens against all right tokens in one rapidfuzz batch
+        and return the best FoundRightToken list for every left token
+        """
+        right_ids = list(right_tokens.keys())
+        right_texts = list(right_tokens.values())
+        if right_tokens_max_id is None:
+            right_tokens_max_id = max(right_ids)
+        found_right_tokens = []
+        for candidates, row_scores in cls._score_right_tokens([default_process(token) for token in left_tokens],
+                                                              [default_process(text) for text in right_texts]):
+            found = []
+            for i in get_top_indices(row_scores, BORDER_TOKEN_LIMIT):
+                if row_scores[i] < BORDER_TOKEN_SCORE_CUTOFF:
+                    continue
+                right_i = i if candidates is None else candidates[i]
+                found.append(FoundRightToken(text=right_texts[right_i],
+                                             rate=int(round(row_scores[i])),
+                                             paragraph_id=right_ids[right_i],
+                                             relative_pos=right_ids[right_i]/right_tokens_max_id,
+                                             score=row_scores[i]))
+            found_right_tokens.append(found)
+        return found_right_tokens
 
 
 class BorderMatch(object):
     def __init__(self, left_bstart_token, left_bend_token, left_border_pid,
-                 right_bstart_tokens, right_bend_tokens, right_chapter):
+                 right_bstart_tokens, right_bend_tokens, right_chapter,
+                 bstart_found_right_tokens=None, bend_found_right_tokens=None):
         self.left_bstart_token = left_bstart_token
         self.left_bend_token = left_bend_token
         self.left_border_pid = left_border_pid
@@ -245,10 +500,10 @@ class BorderMatch(object):
         self.right_bend_tokens = right_bend_tokens
         self.right_chapter = right_chapter
         # logger.debug(f"left_bstart_token='{left_bstart_token}', count(right_bstart_tokens)={len(right_bstart_tokens)}")
-        self.bstart_token_match = BorderTokenMatch(left_bstart_token, right_bstart_tokens)
+        self.bstart_token_match = BorderTokenMatch(left_bstart_token, right_bstart_tokens, bstart_found_right_tokens)
         # logger.debug(f"bstart_token_match='{self.bstart_token_match}")
         # logger.debug(f"left_bstart_token='{left_bend_token}', count(right_bstart_tokens)={len(right_bend_tokens)}")
-        self.bend_token_match = BorderTokenMatch(left_bend_token, right_bend_tokens)
+        self.bend_token_match = BorderTokenMatch(left_bend_token, right_bend_tokens, bend_found_right_tokens)
         # logger.debug(f"bend_token_match='{self.bend_token_match}")
 
         self.best_bstart_right_token, \
@@ -371,7 +626,8 @@ class BorderMatchByBestBorderStartToken(BorderMatchByToken):
 
             if mse < best_mse:
                 best_bs, best_be, best_mse, best_char_distance,  = bs, be, mse, char_distance
-        a = 1
+        if best_bs is None:
+            return best_bs, best_be, best_mse, best_char_distance
         nbr_be_paragraph_id = len(best_bs.text) + best_bs.paragraph_id
         nbr_be_text = self.right_bend_tokens[nbr_be_paragraph_id]
         enforced_best_be = FoundRightToken(text=nbr_be_text,
@@ -384,15 +640,18 @@ class BorderMatchByBestBorderStartToken(BorderMatchByToken):
 
 class MatchedChapter(object):
     """Chapter that match left and right side, check and spawn subchapter if possible"""
+    border_match_class = BorderMatch
+
     def __init__(self, left_chapter: ChapterSide, right_chapter: ChapterSide, nbrs: tuple = (None, None),
-                 born_border_match: float = None):
+                 born_border_match: float = None, spawned_from: 'MatchedChapter' = None):
         self.left_chapter = left_chapter
         self.right_chapter = right_chapter
         self.se2_id = (left_chapter.start_id, left_chapter.end_id), (right_chapter.start_id, right_chapter.end_id)
         self.right_bstart_tokens = dict()
         self.right_bend_tokens = dict()
+        self.found_right_tokens = dict()
         self._get_right_tokens()
-        self.border_matches_heap = self._fill_border_matches_heap()
+        self.border_matches_heap = self._fill_border_matches_heap(spawned_from)
         self.born_border_match = born_border_match
         self.born_datetime = dt.datetime.now()
         self.is_obsolete = False
@@ -405,6 +664,12 @@ class MatchedChapter(object):
                f'prev={self.prev.se2_id if self.prev else None}, ' \
                f'next={self.next.se2_id if self.next else None})'
 
+    def __getstate__(self):
+        """Neighbour chapters are not pickled, so a chapter can be spawned in another process"""
+        state = self.__dict__.copy()
+        state['prev'] = state['next'] = None
+        return state
+
     def _get_right_tokens(self):
         """
         Fill right_bstart_tokens with tokens that may be in the start of the border - end of current paragraph.
@@ -418,22 +683,110 @@ class MatchedChapter(object):
                 self.right_bend_tokens[right_p.global_position] = right_p.tokens[0]
             right_p = right_p.next
 
-    def _fill_border_matches_heap(self):
-        border_matches_heap = []
+    def _get_left_borders(self):
+        """Pairs of neighbour left paragraphs, the border between them may be matched on the right side"""
         left_p = self.left_chapter.paragraphs[self.left_chapter.start_id]
         while left_p.global_position < self.left_chapter.end_id:
+            yield left_p, left_p.next
+            left_p = left_p.next
+
+    @property
+    def right_tokens_offset(self):
+        """Global position of right token id 0"""
+        return 0
+
+    @staticmethod
+    def _get_new_right_token_ids(right_tokens: dict, parent_right_tokens: dict, shift: int):
+        """Ids of right tokens the parent chapter has not scored, shift moves them to parent right token ids"""
+        return [token_id for token_id, token in right_tokens.items() if parent_right_tokens.get(token_id + shift) != token]
+
+    @staticmethod
+    def _find_right_tokens(left_tokens: list, right_tokens: dict, parent_found_right_tokens: list,
+                           new_right_token_ids: list, shift: int):
+        """
+        Found right tokens for every left token.
+        If all right tokens found by the parent chapter are in right_tokens, they are still the best among the right
+        tokens shared with the parent, so only new right tokens are scored for that left token and merged in.
+        Other left tokens are scored against all right tokens
+        """
+        right_tokens_max_id = max(right_tokens.keys())
+        found_right_tokens = []
+        inherited_ids = []
+        missing_ids = []
+        for i, parent_found in enumerate(parent_found_right_tokens):
+            if parent_found is not None and all(right_tokens.get(found.paragraph_id - shift) == found.text
+                                                for found in parent_found):
+                inherited_ids.append(i)
+                found_right_tokens.append([replace(found, paragraph_id=found.paragraph_id - shift,
+                                                   relative_pos=(found.paragraph_id - shift)/right_tokens_max_id)
+                                           for found in parent_found])
+            else:
+                missing_ids.append(i)
+                found_right_tokens.append(None)
+        if inherited_ids and new_right_token_ids:
+            new_found_right_tokens = BorderTokenMatch.find_right_tokens(
+                [left_tokens[i] for i in inherited_ids],
+                {token_id: right_tokens[token_id] for token_id in new_right_token_ids},
+                right_tokens_max_id
+            )
+            for i, new_found in zip(inherited_ids, new_found_right_tokens):
+                found_right_tokens[i] = sorted(found_right_tokens[i] + new_found,
+                                               key=lambda found: (-found.score, found.paragraph_id))[:BORDER_TOKEN_LIMIT]
+        if missing_ids:
+            missing_found_right_tokens = BorderTokenMatch.find_right_tokens([left_tokens[i] for i in missing_ids],
+                                                                            right_tokens)
+            for i, found in zip(missing_ids, missing_found_right_tokens):
+                found_right_tokens[i] = found
+        return found_right_tokens
+
+    def _fill_border_matches_heap(self, spawned_from):
+        """
+        Score left borders against right tokens.
+        A chapter spawned from another one reuses the right tokens the parent has found for the same left borders
+        """
+        border_matches_heap = []
+        left_borders = list(self._get_left_borders())
+        if not left_borders or not self.right_bstart_tokens or not self.right_bend_tokens:
+            return border_matches_heap
+        if spawned_from is None:
+            shift = 0
+            parent_found = [(None, None)] * len(left_borders)
+            new_bstart_token_ids = new_bend_token_ids = []
+        else:
+            shift = self.right_tokens_offset - spawned_from.right_tokens_offset
+            parent_found = [spawned_from.found_right_tokens.get(left_border, (None, None))
+                            for left_border in left_borders]
+            new_bstart_token_ids = self._get_new_right_token_ids(self.right_bstart_tokens,
+                                                                 spawned_from.right_bstart_tokens, shift)
+            new_bend_token_ids = self._get_new_right_token_ids(self.right_bend_tokens,
+                                                               spawned_from.right_bend_tokens, shift)
+        try:
+            bstart_found_right_tokens = self._find_right_tokens(
+                [left_p.tokens[-1] for left_p, _ in left_borders], self.right_bstart_tokens,
+                [bstart_found for bstart_found, _ in parent_found], new_bstart_token_ids, shift
+            )
+            bend_found_right_tokens = self._find_right_tokens(
+                [next_p.tokens[0] for _, next_p in left_borders], self.right_bend_tokens,
+                [bend_found for _, bend_found in parent_found], new_bend_token_ids, shift
+            )
+        except Exception as e:
+            logger.exception(f"Error: {e}")
+            return border_matches_heap
+        self.found_right_tokens = dict(zip(left_borders, zip(bstart_found_right_tokens, bend_found_right_tokens)))
+        for (left_p, next_p), bstart_found, bend_found in zip(left_borders, bstart_found_right_tokens,
+                                                              bend_found_right_tokens):
             try:
-                border_match = BorderMatch(left_bstart_token=left_p.tokens[-1],
-                                           left_bend_token=left_p.next.tokens[0],
-                                           left_border_pid=left_p.next.global_position,
-                                           right_bstart_tokens=self.right_bstart_tokens,
-                                           right_bend_tokens=self.right_bend_tokens,
-                                           right_chapter=self.right_chapter
-                                           )
+                border_match = self.border_match_class(left_bstart_token=left_p.tokens[-1],
+                                                       left_bend_token=next_p.tokens[0],
+                                                       left_border_pid=next_p.global_position,
+                                                       right_bstart_tokens=self.right_bstart_tokens,
+                                                       right_bend_tokens=self.right_bend_tokens,
+                                                       right_chapter=self.right_chapter,
+                                                       bstart_found_right_tokens=bstart_found,
+                                                       bend_found_right_tokens=bend_found)
                 heapq.heappush(border_matches_heap, border_match)
             except Exception as e:
                 logger.exception(f"Error: {e}")
-            left_p = left_p.next
         return border_matches_heap
 
     def spawn_possible(self, thr):
@@ -460,10 +813,12 @@ class MatchedChapter(object):
             )
 
             parent = MatchedChapter(parent_left_chapter, parent_right_chapter,
-                                    nbrs=(self.prev, None), born_border_match=self.born_border_match)
+                                    nbrs=(self.prev, None), born_border_match=self.born_border_match,
+                                    spawned_from=self)
             logger.info(f'parent is {parent}')
             child = MatchedChapter(child_left_chapter, child_right_chapter,
-                                   nbrs=(parent, self.next), born_border_match=best_border_match.border_rate)
+                                   nbrs=(parent, self.next), born_border_match=best_border_match.border_rate,
+                                   spawned_from=self)
             logger.info(f'child is {child}')
             parent.next = child
             if self.prev:
@@ -475,6 +830,13 @@ class MatchedChapter(object):
 
 
 class MatchedChapterByToken(MatchedChapter):
+    border_match_class = BorderMatchByToken
+
+    @property
+    def right_tokens_offset(self):
+        """Right token ids are positions within symbols of the first paragraph of the right chapter"""
+        return self.right_chapter.paragraphs[self.right_chapter.start_id].symbols_position
+
     # def __init__(self, left_chapter: ChapterSide, right_chapter: ChapterSide, nbrs: tuple = (None, None),
     #              born_border_match: float = None):
     #     # combined_text = ' '.join([p.symbols for p in right_chapter.paragraphs.values()])
@@ -499,24 +861,6 @@ class MatchedChapterByToken(MatchedChapter):
             if token_start != first_right_token_id:
                 self.right_bend_tokens[token_start] = token
 
-    def _fill_border_matches_heap(self):
-        border_matches_heap = []
-        left_p = self.left_chapter.paragraphs[self.left_chapter.start_id]
-        while left_p.global_position < self.left_chapter.end_id:
-            try:
-                border_match = BorderMatchByToken(left_bstart_token=left_p.tokens[-1],
-                                                  left_bend_token=left_p.next.tokens[0],
-                                                  left_border_pid=left_p.next.global_position,
-                                                  right_bstart_tokens=self.right_bstart_tokens,
-                                                  right_bend_tokens=self.right_bend_tokens,
-                                                  right_chapter=self.right_chapter
-                                                  )
-                heapq.heappush(border_matches_heap, border_match)
-            except Exception as e:
-                print(f"Error: {e}")
-            left_p = left_p.next
-        return border_matches_heap
-
     def spawn_child(self, border_rate_threshold):
         best_border_match = self.border_matches_heap[0]
         if best_border_match.border_rate <= border_rate_threshold:
@@ -531,9 +875,11 @@ class MatchedChapterByToken(MatchedChapter):
             )
 
             parent = MatchedChapterByToken(parent_left_chapter, parent_right_chapter,
-                                           nbrs=(self.prev, None), born_border_match=self.born_border_match)
+                                           nbrs=(self.prev, None), born_border_match=self.born_border_match,
+                                           spawned_from=self)
             child = MatchedChapterByToken(child_left_chapter, child_right_chapter,
-                                          nbrs=(parent, self.next), born_border_match=best_border_match.border_rate)
+                                          nbrs=(parent, self.next), born_border_match=best_border_match.border_rate,
+                                          spawned_from=self)
             parent.next = child
             if self.prev:
                 self.prev.next = parent
@@ -544,48 +890,11 @@ class MatchedChapterByToken(MatchedChapter):
 
 
 class MatchedChapterByBestBorderEndToken(MatchedChapterByToken):
-
-    def _fill_border_matches_heap(self):
-        border_matches_heap = []
-        left_p = self.left_chapter.paragraphs[self.left_chapter.start_id]
-        while left_p.global_position < self.left_chapter.end_id:
-            try:
-                border_match = BorderMatchByBestBorderEndToken(left_bstart_token=left_p.tokens[-1],
-                                                               left_bend_token=left_p.next.tokens[0],
-                                                               left_border_pid=left_p.next.global_position,
-                                                               right_bstart_tokens=self.right_bstart_tokens,
-                                                               right_bend_tokens=self.right_bend_tokens,
-                                                               right_chapter=self.right_chapter
-                                                               )
-                heapq.heappush(border_matches_heap, border_match)
-            except Exception as e:
-                print(f"Error: {e}")
-            left_p = left_p.next
-        return border_matches_heap
-
+    border_match_class = BorderMatchByBestBorderEndToken
 
 
 class MatchedChapterByBestBorderStartToken(MatchedChapterByToken):
-
-    def _fill_border_matches_heap(self):
-        border_matches_heap = []
-        left_p = self.left_chapter.paragraphs[self.left_chapter.start_id]
-        while left_p.global_position < self.left_chapter.end_id:
-            try:
-                border_match = BorderMatchByBestBorderStartToken(left_bstart_token=left_p.tokens[-1],
-                                                                 left_bend_token=left_p.next.tokens[0],
-                                                                 left_border_pid=left_p.next.global_position,
-                                                                 right_bstart_tokens=self.right_bstart_tokens,
-                                                                 right_bend_tokens=self.right_bend_tokens,
-                                                                 right_chapter=self.right_chapter
-                                                                 )
-                heapq.heappush(border_matches_heap, border_match)
-            except Exception as e:
-                print(f"Error: {e}")
-            left_p = left_p.next
-        return border_matches_heap
-
-
+    border_match_class = BorderMatchByBestBorderStartToken
 
 
 def chapters_by_token_factory(head_chapter):
@@ -0,0 +1,104 @@
+import os
+import contextlib
+from collections import OrderedDict
+from contextvars import ContextVar
+import numpy as np
+
+# Scored (left token, right token) pairs kept by one alignment, about 12 bytes per pair
+SCORE_CACHE_MAX_SIZE = int(os.environ.get("SCORE_CACHE_MAX_SIZE", 5 * pow(10, 6)))
+
+
+class ScoreCache(object):
+    """
+    Bounded memo of token pair scores. Tokens are interned to int ids, scores of every left token are kept
+    as a row of right token ids sorted for np.searchsorted. Rows are evicted in least recently used order
+    """
+
+    def __init__(self, max_size: int = SCORE_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._token_ids = dict()
+        self._rows = OrderedDict()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(tokens={len(self._token_ids)}, rows={len(self._rows)}, size={self.size}, ' \
+               f'hits={self.hits}, misses={self.misses})'
+
+    def _intern(self, tokens: list):
+        return np.array([self._token_ids.setdefault(token, len(self._token_ids)) for token in tokens], dtype=np.int64)
+
+    def _get_row_scores(self, left_id: int, right_ids):
+        """Cached scores of the left token against all right_ids, None if some of them are not cached"""
+        row = self._rows.get(left_id)
+        if row is None:
+            return None
+        row_right_ids, row_scores = row
+        positions = np.minimum(np.searchsorted(row_right_ids, right_ids), len(row_right_ids) - 1)
+        if not np.array_equal(row_right_ids[positions], right_ids):
+            return None
+        self._rows.move_to_end(left_id)
+        return row_scores[positions]
+
+    def _put_row_scores(self, left_id: int, right_ids, scores):
+        row = self._rows.pop(left_id, None)
+        if row is not None:
+            self.size -= len(row[0])
+            right_ids = np.concatenate((right_ids, row[0]))
+            scores = np.concatenate((scores, row[1]))
+        right_ids, unique_positions = np.unique(right_ids, return_index=True)
+        self._rows[left_id] = right_ids, scores[unique_positions]
+        self.size += len(right_ids)
+        while self.size > self.max_size and len(self._rows) > 1:
+            _, (evicted_right_ids, _) = self._rows.popitem(last=False)
+            self.size -= len(evicted_right_ids)
+
+    def get_scores(self, left_tokens: list, right_tokens: list, score):
+        """
+        Matrix of scores of left_tokens against right_tokens. Rows that are not cached in full
+        are scored with score(left_tokens, right_tokens) in one batch and cached
+        """
+        left_ids = self._intern(left_tokens)
+        right_ids = self._intern(right_tokens)
+        scores = None
+        missing_rows = []
+        for i, left_id in enumerate(left_ids):
+            row_scores = self._get_row_scores(left_id, right_ids)
+            if row_scores is None:
+                missing_rows.append(i)
+                continue
+            if scores is None:
+                scores = np.empty((len(left_ids), len(right_ids)), dtype=row_scores.dtype)
+            scores[i] = row_scores
+            self.hits += len(right_ids)
+        if missing_rows:
+            missing_scores = score([left_tokens[i] for i in missing_rows], right_tokens)
+            if scores is None:
+                scores = np.empty((len(left_ids), len(right_ids)), dtype=missing_scores.dtype)
+            for i, row_scores in zip(missing_rows, missing_scores):
+                scores[i] = row_scores
+                self._put_row_scores(left_ids[i], right_ids, row_scores)
+            self.misses += len(missing_rows) * len(right_ids)
+        if scores is None:
+            scores = np.empty((0, len(right_ids)), dtype=np.float32)
+        return scores
+
+
+_score_cache: ContextVar = ContextVar('score_cache', default=None)
+
+
+def get_score_cache():
+    """Score cache of the current alignment, None outside of use_score_cache"""
+    return _score_cache.get()
+
+
+@contextlib.contextmanager
+def use_score_cache(max_size: int = SCORE_CACHE_MAX_SIZE):
+    """Share one ScoreCache between all token scoring in the block, the cache is dropped when the block ends"""
+    score_cache = ScoreCache(max_size)
+    token = _score_cache.set(score_cache)
+    try:
+        yield score_cache
+    finally:
+        _score_cache.reset(token)
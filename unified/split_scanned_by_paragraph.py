@@ -1,42 +1,52 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
 from unified.paragraph import paragraph_factory, chapters_by_token_factory, MatchedChapter, ChapterSide, logger
 from unified.paragraph import chapters_by_best_be_token_factory, chapters_by_best_bs_token_factory
-from typing import List
+from unified.paragraph import MatchedChapterByBestBorderEndToken
+from unified.paragraph import ParagraphStore, get_paragraphs_chain, link_paragraphs_chain, replace_paragraphs_chain
+from unified.score_cache import use_score_cache
+from unified.exact_anchors import find_exact_anchors
+from typing import List, Optional
 # logger = logging.getLogger(__name__)
 
+# 0 or 1 spawn chapters in the current process
+SPAWN_WORKERS = int(os.environ.get("SPAWN_WORKERS", 0))
+# Chapters of every threshold iteration are dumped to files in this directory only if it is set
+CHAPTERS_DUMP_DIR = os.environ.get("CHAPTERS_DUMP_DIR")
+
+
+def get_chapters_texts(head_chapter):
+    """Left and right texts of all chapters, every chapter ends with a new line"""
+    texts_left = []
+    texts_right = []
+    chapter = head_chapter
+    while chapter:
+        texts_left.append(chapter.left_chapter.get_text())
+        texts_right.append(chapter.right_chapter.get_text())
+        chapter = chapter.next
+    return ''.join(f'{text}\n' for text in texts_left), ''.join(f'{text}\n' for text in texts_right)
+
 
 def write_chapters_to_files(head_chapter, filename_prefix, thr):
-    text_left = ''
-    text_right = ''
-    with open(f'{filename_prefix}_left_{thr}.txt', 'w') as f_left:
-        with open(f'{filename_prefix}_right_{thr}.txt', 'w') as f_right:
+    """Dump chapters of a threshold iteration to CHAPTERS_DUMP_DIR for debugging"""
+    with open(os.path.join(CHAPTERS_DUMP_DIR, f'{filename_prefix}_left_{thr}.txt'), 'w') as f_left:
+        with open(os.path.join(CHAPTERS_DUMP_DIR, f'{filename_prefix}_right_{thr}.txt'), 'w') as f_right:
             write_chapter = head_chapter
             while write_chapter:
                 header_to_write = f"se2_id: {write_chapter.se2_id}, born_border_match: " \
                                   f"{write_chapter.born_border_match}, timestamp: {write_chapter.born_datetime}\n"
                 f_left.write(header_to_write)
                 f_right.write(header_to_write)
-
-                lines_to_write = ''
-                for key, val in write_chapter.left_chapter.paragraphs.items():
-                    if key >= write_chapter.left_chapter.start_id and key <= write_chapter.left_chapter.end_id:
-                        lines_to_write += val.symbols
-                f_left.writelines(lines_to_write)
-                text_left += lines_to_write
-                text_left += '\n'
-
-                lines_to_write = ''
-                for key, val in write_chapter.right_chapter.paragraphs.items():
-                    if key >= write_chapter.right_chapter.start_id and key <= write_chapter.right_chapter.end_id:
-                        lines_to_write += val.symbols
-                f_right.writelines(lines_to_write)
-                text_right += lines_to_write
-                text_right += '\n'
-
+                f_left.write(write_chapter.left_chapter.get_text())
+                f_right.write(write_chapter.right_chapter.get_text())
                 write_chapter = write_chapter.next
-    return text_left, text_right
 
 
-def spawn_chapters(head_chapter: MatchedChapter, thr):
+def spawn_chapters(head_chapter: MatchedChapter, thr, executor: Executor = None):
+    if executor is not None:
+        return spawn_chapters_in_pool(head_chapter, thr, executor)
     next_chapter = head_chapter
     while next_chapter:
         current_chapter = next_chapter
@@ -54,6 +64,94 @@ def spawn_chapters(head_chapter: MatchedChapter, thr):
     return head_chapter
 
 
+def get_chapter_chains(chapter: MatchedChapter):
+    return (get_paragraphs_chain(chapter.left_chapter.paragraphs,
+                                 chapter.left_chapter.start_id, chapter.left_chapter.end_id),
+            get_paragraphs_chain(chapter.right_chapter.paragraphs,
+                                 chapter.right_chapter.start_id, chapter.right_chapter.end_id))
+
+
+def get_detached_chains(left_paragraphs: ParagraphStore, right_paragraphs: ParagraphStore):
+    """Whole chains of detached paragraphs, split paragraphs may be after the end of the spawned chapter"""
+    return (get_paragraphs_chain(left_paragraphs, next(iter(left_paragraphs)), next(reversed(left_paragraphs))),
+            get_paragraphs_chain(right_paragraphs, next(iter(right_paragraphs)), next(reversed(right_paragraphs))))
+
+
+def spawn_detached_chapter(chapter: MatchedChapter, left_chain, right_chain, thr):
+    """
+    Runs in a worker process. The chapter comes without neighbours and with paragraphs of its ranges only.
+    Returns the chapters it is spawned to and new paragraph chains of its ranges
+    """
+    link_paragraphs_chain(left_chain)
+    link_paragraphs_chain(right_chain)
+    left_paragraphs = ParagraphStore((p.global_position, p) for p in left_chain)
+    right_paragraphs = ParagraphStore((p.global_position, p) for p in right_chain)
+    chapter.left_chapter.paragraphs = left_paragraphs
+    chapter.right_chapter.paragraphs = right_paragraphs
+    chapters = [chapter]
+    while chapters[-1].spawn_possible(thr):
+        logger.info(f'current_chapter is {chapters[-1]}')
+        chapters[-1:] = chapters[-1].spawn_child(thr)
+    return chapters, *get_detached_chains(left_paragraphs, right_paragraphs)
+
+
+def spawn_chapters_in_pool(head_chapter: MatchedChapter, thr, executor: Executor):
+    """
+    Spawning of a chapter never touches ranges of other chapters, so every chapter that may be spawned
+    is sent to a worker and the chapters it is spawned to are put back in its place in the linked list
+    """
+    spawn_possible_chapters = []
+    chapter = head_chapter
+    while chapter:
+        if chapter.spawn_possible(thr):
+            spawn_possible_chapters.append(chapter)
+        chapter = chapter.next
+    if len(spawn_possible_chapters) < 2:
+        return spawn_chapters(head_chapter, thr)
+
+    chains = [get_chapter_chains(chapter) for chapter in spawn_possible_chapters]
+    futures = [executor.submit(spawn_detached_chapter, chapter, left_chain, right_chain, thr)
+               for chapter, (left_chain, right_chain) in zip(spawn_possible_chapters, chains)]
+    results = [future.result() for future in futures]
+
+    for chapter, (left_chain, right_chain), (chapters, new_left_chain, new_right_chain) in \
+            zip(spawn_possible_chapters, chains, results):
+        left_paragraphs = chapter.left_chapter.paragraphs
+        right_paragraphs = chapter.right_chapter.paragraphs
+        replace_paragraphs_chain(left_paragraphs, left_chain, new_left_chain)
+        replace_paragraphs_chain(right_paragraphs, right_chain, new_right_chain)
+        for spawned_chapter in chapters:
+            spawned_chapter.left_chapter.paragraphs = left_paragraphs
+            spawned_chapter.right_chapter.paragraphs = right_paragraphs
+        for prev_chapter, next_chapter in zip([chapter.prev] + chapters, chapters + [chapter.next]):
+            if prev_chapter:
+                prev_chapter.next = next_chapter
+            if next_chapter:
+                next_chapter.prev = prev_chapter
+        chapter.is_obsolete = True
+        if chapter is head_chapter:
+            head_chapter = chapters[0]
+    return head_chapter
+
+
+_spawn_executor: Optional[Executor] = None
+_spawn_executor_lock = threading.Lock()
+
+
+def get_spawn_executor() -> Optional[Executor]:
+    """
+    Process pool shared by all requests, created on first use, None if SPAWN_WORKERS is not greater than 1.
+    Workers are spawned, not forked: a fork of the threaded server could inherit a lock held by another thread
+    """
+    global _spawn_executor
+    if SPAWN_WORKERS <= 1:
+        return None
+    with _spawn_executor_lock:
+        if _spawn_executor is None:
+            _spawn_executor = ProcessPoolExecutor(SPAWN_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _spawn_executor
+
+
 def flatten_right_paragraphs_text(head_chapter):
     right_text = ''
     next_chapter = head_chapter
@@ -74,100 +172,186 @@ def flatten_right_paragraphs_text(head_chapter):
     return right_text_by_lines
 
 
-def match_chapter_1(left_chapter, right_chapter, max_thr):
+def split_chapter_side(chapter_side: ChapterSide, positions: list):
+    """Pieces of the chapter side, every piece but the first one starts at the next position"""
+    chapter_sides = []
+    for pos in positions:
+        parent, chapter_side = chapter_side.spawn_child(pos)
+        chapter_sides.append(parent)
+    chapter_sides.append(chapter_side)
+    return chapter_sides
+
+
+def pre_align_chapters(left_chapter: ChapterSide, right_chapter: ChapterSide):
+    """
+    Linked chapters split at exact anchors, so fuzzy spawning looks for borders only between the anchors.
+    Anchors at the start of a side can't split it
+    """
+    anchors = [(left_pos, right_pos) for left_pos, right_pos in find_exact_anchors(left_chapter, right_chapter)
+               if left_pos != left_chapter.start_id and right_pos != right_chapter.start_id]
+    logger.info(f'pre_align_chapters found {len(anchors)} anchors')
+    left_sides = split_chapter_side(left_chapter, [left_pos for left_pos, _ in anchors])
+    right_sides = split_chapter_side(right_chapter, [right_pos for _, right_pos in anchors])
+    head_chapter = prev_chapter = None
+    for left_side, right_side in zip(left_sides, right_sides):
+        chapter = MatchedChapter(left_side, right_side, nbrs=(prev_chapter, None))
+        if prev_chapter is None:
+            head_chapter = chapter
+        else:
+            prev_chapter.next = chapter
+        prev_chapter = chapter
+    return head_chapter
+
+
+def match_chapter_1(left_chapter, right_chapter, max_thr, executor: Executor = None):
     logger.info('MatchedChapter - 1st iteration')
-    head_chapter = MatchedChapter(left_chapter, right_chapter)
+    head_chapter = pre_align_chapters(left_chapter, right_chapter)
     thr = .1
     while thr < max_thr:
         logger.info(f'Next thr cycle started.! thr is {thr}')
-        head_chapter = spawn_chapters(head_chapter, thr)
+        head_chapter = spawn_chapters(head_chapter, thr, executor)
         # write_chapters_to_files(head_chapter, 'thr', thr)
 
         thr *= 1 + 0.618
     return head_chapter
 
 
-def match_chapter_2(left_chapter, head_chapter, max_thr):
+def match_chapter_2(left_chapter, head_chapter, max_thr, executor: Executor = None):
     logger.info('flatten_right_paragraphs_text...')
     right_text = flatten_right_paragraphs_text(head_chapter)
     # Build data structeres from the scratch
     right_paragraphs = paragraph_factory(right_text)
     right_chapter = ChapterSide(right_paragraphs, 0, next(reversed(right_paragraphs)))
-    head_chapter = MatchedChapter(left_chapter, right_chapter)
+    head_chapter = pre_align_chapters(left_chapter, right_chapter)
 
     #       2. run MatchedChapter spawn_subchapter cycle once again
     logger.info('MatchedChapter - 2nd iteration')
     thr = .1
     while thr < max_thr:
-        head_chapter = spawn_chapters(head_chapter, thr)
+        head_chapter = spawn_chapters(head_chapter, thr, executor)
         # write_chapters_to_files(head_chapter, 'thr2', thr)
         thr *= 1 + 0.618
 
     return head_chapter
 
 
-def match_chapter_bt(head_chapter, max_thr):
+def spawn_chapters_bt(head_chapter_bt, max_thr, executor: Executor = None):
+    thr = .1
+    while thr < max_thr * pow(0.618, 1):
+        head_chapter_bt = spawn_chapters(head_chapter_bt, thr, executor)
+        if CHAPTERS_DUMP_DIR:
+            write_chapters_to_files(head_chapter_bt, 'bt_thr', thr)
+
+        thr *= 1 + 0.618
+        logger.debug(f'Next thr is {thr}')
+    return head_chapter_bt
+
+
+def match_chapter_bt(head_chapter, max_thr, executor: Executor = None):
     logger.info('chapters_by_token_factory...')
     head_chapter_bt = chapters_by_token_factory(head_chapter)
 
     logger.info('MatchedChapterByToken iteration')
+    head_chapter_bt = spawn_chapters_bt(head_chapter_bt, max_thr, executor)
+    left_final, right_final = get_chapters_texts(head_chapter_bt)
+    return left_final, right_final, head_chapter_bt
+
+
+def spawn_chapters_be_bt(head_chapter_best_be_bt, max_thr, executor: Executor = None, filename_prefix=None):
     thr = .1
-    while thr < max_thr * pow(0.618, 1):
-        head_chapter_bt = spawn_chapters(head_chapter_bt, thr)
-        left_final, right_final = write_chapters_to_files(head_chapter_bt, 'bt_thr', thr)
+    while thr < max_thr * pow(0.618, 8):  # 15 mean run only once
+        head_chapter_best_be_bt = spawn_chapters(head_chapter_best_be_bt, thr, executor)
+        if CHAPTERS_DUMP_DIR and filename_prefix:
+            write_chapters_to_files(head_chapter_best_be_bt, filename_prefix, thr)
 
         thr *= 1 + 0.618
-        print(thr)
-    a = 1
-    return left_final, right_final, head_chapter_bt
+        logger.debug(f'Next thr is {thr}')
+    return head_chapter_best_be_bt
 
 
-def match_chapter_be_bt(head_chapter_bt, max_thr):
+def match_chapter_be_bt(head_chapter_bt, max_thr, executor: Executor = None):
     logger.info('chapters_by_best_be_token_factory...')
     head_chapter_best_be_bt = chapters_by_best_be_token_factory(head_chapter_bt)
     # logger.info('MatchedChapterByBestToken iteration')
-    thr = .1
-    while thr < max_thr * pow(0.618, 8):  # 15 mean run only once
-        head_chapter_best_be_bt = spawn_chapters(head_chapter_best_be_bt, thr)
-        left_final, right_final = write_chapters_to_files(head_chapter_best_be_bt, 'best_be_bt_thr', thr)
+    head_chapter_best_be_bt = spawn_chapters_be_bt(head_chapter_best_be_bt, max_thr, executor, 'best_be_bt_thr')
+    left_final, right_final = get_chapters_texts(head_chapter_best_be_bt)
+    return left_final, right_final, head_chapter_best_be_bt
 
-        thr *= 1 + 0.618
-        print(thr)
 
-    return left_final, right_final, head_chapter_best_be_bt
+def iter_chapters_be_bt(head_chapter_bt, max_thr):
+    """
+    match_chapter_be_bt that settles chapters one by one. Spawning of a chapter doesn't depend on other chapters,
+    so each chapter runs all threshold iterations and its spawned chapters are yielded before the next one starts
+    """
+    chapter_bt = head_chapter_bt
+    while chapter_bt:
+        chapter = spawn_chapters_be_bt(MatchedChapterByBestBorderEndToken(left_chapter=chapter_bt.left_chapter,
+                                                                          right_chapter=chapter_bt.right_chapter),
+                                       max_thr)
+        while chapter:
+            yield chapter
+            chapter = chapter.next
+        chapter_bt = chapter_bt.next
 
 
-def match_chapter_bs_bt(head_chapter_bt, max_thr):
+def match_chapter_bs_bt(head_chapter_bt, max_thr, executor: Executor = None):
     logger.info('chapters_by_best_be_token_factory...')
     head_chapter_best = chapters_by_best_bs_token_factory(head_chapter_bt)
     # logger.info('MatchedChapterByBestToken iteration')
     thr = .1
     while thr < max_thr * pow(0.618, 8):  # 15 mean run only once
-        head_chapter_best = spawn_chapters(head_chapter_best, thr)
-        left_final, right_final = write_chapters_to_files(head_chapter_best, 'best_be_bt_thr', thr)
+        head_chapter_best = spawn_chapters(head_chapter_best, thr, executor)
+        if CHAPTERS_DUMP_DIR:
+            write_chapters_to_files(head_chapter_best, 'best_be_bt_thr', thr)
 
         thr *= 1 + 0.618
-        print(thr)
+        logger.debug(f'Next thr is {thr}')
 
+    left_final, right_final = get_chapters_texts(head_chapter_best)
     return left_final, right_final, head_chapter_best
 
 
-def main(source_left: List[str], source_right: List[str], max_thr):
+def match_chapters_before_last_stage(source_left: List[str], source_right: List[str], max_thr,
+                                     executor: Executor = None):
     left_paragraphs = paragraph_factory(source_left)
     right_paragraphs = paragraph_factory(source_right)
 
     left_chapter = ChapterSide(left_paragraphs, 0, next(reversed(left_paragraphs)))
     right_chapter = ChapterSide(right_paragraphs, 0, next(reversed(right_paragraphs)))
 
-    head_chapter = match_chapter_1(left_chapter, right_chapter, max_thr)
-    head_chapter = match_chapter_2(left_chapter, head_chapter, max_thr)
-    left_final, right_final, head_chapter_bt = match_chapter_bt(head_chapter, max_thr)
-    left_final, right_final, head_chapter_be_bt = match_chapter_be_bt(head_chapter_bt, max_thr)
-    left_final, right_final, head_chapter_bs_bt = match_chapter_be_bt(head_chapter_be_bt, max_thr)
+    head_chapter = match_chapter_1(left_chapter, right_chapter, max_thr, executor)
+    head_chapter = match_chapter_2(left_chapter, head_chapter, max_thr, executor)
+    logger.info('chapters_by_token_factory...')
+    head_chapter_bt = spawn_chapters_bt(chapters_by_token_factory(head_chapter), max_thr, executor)
+    logger.info('chapters_by_best_be_token_factory...')
+    return spawn_chapters_be_bt(chapters_by_best_be_token_factory(head_chapter_bt), max_thr, executor,
+                                'best_be_bt_thr')
+
+
+def main(source_left: List[str], source_right: List[str], max_thr):
+    # chapters spawned in worker processes don't share the score cache
+    executor = get_spawn_executor()
+    with use_score_cache() as score_cache:
+        head_chapter_be_bt = match_chapters_before_last_stage(source_left, source_right, max_thr, executor)
+        left_final, right_final, head_chapter_bs_bt = match_chapter_be_bt(head_chapter_be_bt, max_thr, executor)
+        logger.info(f'{score_cache}')
 
     return left_final, right_final
 
 
+def iter_main(source_left: List[str], source_right: List[str], max_thr):
+    """
+    main that yields left and right texts of every final chapter as soon as the last stage settles it,
+    joined together they are the texts main returns
+    """
+    executor = get_spawn_executor()
+    with use_score_cache() as score_cache:
+        head_chapter_be_bt = match_chapters_before_last_stage(source_left, source_right, max_thr, executor)
+        for chapter in iter_chapters_be_bt(head_chapter_be_bt, max_thr):
+            yield f'{chapter.left_chapter.get_text()}\n', f'{chapter.right_chapter.get_text()}\n'
+        logger.info(f'{score_cache}')
+
+
 if __name__ == '__main__':
     with open('left.txt') as f:
         left_text_ = f.readlines()
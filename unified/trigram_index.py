@@ -0,0 +1,41 @@
+from functools import lru_cache
+import numpy as np
+
+
+@lru_cache(maxsize=pow(2, 16))
+def get_trigram_hashes(text):
+    """Hashes of distinct character trigrams of the text, cached because the same tokens meet in many chapters"""
+    padded_text = f' {text} '
+    return np.array(sorted({hash(padded_text[i:i + 3]) for i in range(len(padded_text) - 2)}), dtype=np.int64)
+
+
+class TrigramIndex(object):
+    """Character trigram inverted index over the right tokens of one chapter"""
+
+    def __init__(self, texts):
+        self.texts_count = len(texts)
+        text_hashes = [get_trigram_hashes(text) for text in texts]
+        hashes = np.concatenate(text_hashes)
+        text_ids = np.repeat(np.arange(self.texts_count, dtype=np.int32), [len(h) for h in text_hashes])
+        order = np.argsort(hashes, kind='stable')
+        # postings of a trigram are the text ids in the slice where its hash is in sorted hashes
+        self.hashes = hashes[order]
+        self.text_ids = text_ids[order]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(texts_count={self.texts_count}, postings_count={len(self.hashes)})'
+
+    def get_candidates(self, text, limit):
+        """Sorted ids of at most `limit` texts sharing the most trigrams with `text`"""
+        text_hashes = get_trigram_hashes(text)
+        starts = np.searchsorted(self.hashes, text_hashes, side='left')
+        ends = np.searchsorted(self.hashes, text_hashes, side='right')
+        postings = [self.text_ids[start:end] for start, end in zip(starts, ends) if start != end]
+        if not postings:
+            return np.array([], dtype=np.int32)
+        shared_counts = np.bincount(np.concatenate(postings), minlength=self.texts_count)
+        candidates = np.flatnonzero(shared_counts)
+        if len(candidates) > limit:
+            best = np.argpartition(shared_counts[candidates], len(candidates) - limit)[len(candidates) - limit:]
+            candidates = np.sort(candidates[best])
+        return candidates